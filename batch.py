@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+import errno
+import glob
+import re
+import shutil
+import struct
+import subprocess
+import traceback
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+
+from PyQt5.QtCore import QObject, Qt, QBuffer, QByteArray, QIODevice, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+import gi
+gi.require_version('GExiv2', '0.10')
+from gi.repository import GExiv2
+
+from rename_pictures import rename_file, by_date_format, init_worker
+from timing import Timings
+import exif
+
+import logging
+logger = logging.getLogger("batch")
+
+# TODO: put paths in config file
+STITCH_DIR = '/home/mdione/Pictures/incoming/02-new/stitch'
+COMPARE_DIR = '/home/mdione/Pictures/incoming/03-cur'
+
+
+def resize(src, dst):
+    # QImage and not QPixmap, so this can run outside the UI thread,
+    # and in other processes
+    src_i = QImage(src)
+    dst_i = src_i.scaled(4500, 3000, Qt.KeepAspectRatio,
+                         Qt.SmoothTransformation)
+
+    with open(src, 'rb') as f:
+        is_jpeg = f.read(2) == exif.SOI
+
+    if not is_jpeg:
+        resize_with_gexiv2(src, dst, dst_i)
+        return
+
+    # encode it in memory
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    if not dst_i.save(buffer, 'JPEG'):
+        raise OSError(f"could not encode {src}")
+    buffer.close()
+
+    data = add_metadata(bytes(data), src, dst_i.width(), dst_i.height())
+    verify(data, dst_i)
+
+    # it's also linked in ByDate (see rename_file()), which has always
+    # ended up with the resized image too
+    links = by_date_links(src)
+
+    tmp = dst + '.tmp'
+    write_file(tmp, data)
+    os.replace(tmp, dst)
+
+    # src is still whole until the resized image is in all its places
+    for link in links:
+        replace_link(link, dst)
+
+    if os.path.abspath(src) != os.path.abspath(dst):
+        os.unlink(src)
+
+
+def by_date_links(path):
+    """The other names of path in ByDate; rename_file() links it with the
+    same name."""
+    stat = os.stat(path)
+    if stat.st_nlink == 1:
+        return []
+
+    pattern = os.path.join(re.sub('%.', '*', by_date_format), os.path.basename(path))
+    links = []
+    for link in glob.glob(pattern):
+        try:
+            if os.path.abspath(link) != os.path.abspath(path) and os.path.samestat(os.stat(link), stat):
+                links.append(link)
+        except OSError:
+            pass
+
+    return links
+
+
+def replace_link(path, target):
+    """Make path another name of target, or a copy of it if they're in
+    different filesystems, without path ever missing or half written."""
+    tmp = path + '.tmp'
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(target, tmp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        with open(target, 'rb') as f:
+            write_file(tmp, f.read())
+
+    os.replace(tmp, path)
+
+
+def add_metadata(data, src, width, height):
+    """Copy the EXIF, XMP and IPTC segments from the JPEG file src into the
+    JPEG data, as they are, except for the image's size."""
+    with open(src, 'rb') as f:
+        segments = []
+        for marker, segment_data in exif.jpeg_segments(f):
+            # EXIF and XMP go in APP1 segments, IPTC in APP13
+            if marker in (exif.APP1, exif.APP13):
+                if segment_data.startswith(exif.EXIF_HEADER):
+                    segment_data = exif.set_pixel_dimensions(segment_data, width, height)
+
+                segments.append(exif.segment(marker, segment_data))
+
+    # put them after the JFIF header Qt writes
+    position = 2
+    if data[2:4] == bytes((0xff, exif.APP0)):
+        length, = struct.unpack('>H', data[4:6])
+        position = 4 + length
+
+    return data[:position] + b''.join(segments) + data[position:]
+
+
+def verify(data, image):
+    """Check that the resulting file is readable and has the right size."""
+    buffer = QBuffer()
+    buffer.setData(data)
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer, b'JPEG')
+
+    if not reader.canRead() or reader.size() != image.size():
+        raise OSError(f"resized image failed verification: {reader.errorString()}")
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+        # so it's on disk before it replaces anything
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def resize_with_gexiv2(src, dst, dst_i):
+    """For other formats, like PNG, copy the metadata tag by tag."""
+    src_meta = GExiv2.Metadata(src)
+
+    tmp = dst + '.tmp'
+    if not dst_i.save(tmp, os.path.splitext(src)[1][1:]):
+        raise OSError(f"could not encode {src}")
+
+    # copy all the metadata
+    dst_meta = GExiv2.Metadata(tmp)
+    for tag in src_meta.get_tags():
+        dst_meta[tag] = src_meta[tag]
+
+    dst_meta.save_file()
+
+    links = by_date_links(src)
+    os.replace(tmp, dst)
+    for link in links:
+        replace_link(link, dst)
+
+    if os.path.abspath(src) != os.path.abspath(dst):
+        os.unlink(src)
+
+
+class Batch(QObject):
+    """Applies the actions tagged on the images in a background thread.
+
+    jobs is a list of (Image, action); the action is taken when the batch is
+    created, so retagging the image later doesn't change what's done. New
+    files that are not tagged come with None, and are just renamed.
+    cancel() stops it before the next file.
+
+    The resizes for 'Take' are done in a pool of `workers` processes (by
+    default, one per CPU), so they're reported as they finish, not in order.
+
+    New files are renamed (see rename_file()) before anything else is done
+    with them; renamed maps their paths to the new ones, and is kept by the
+    caller between batches, so a failed job can be applied again.
+
+    The whole batch is timed as the 'apply' stage in timings, and each file
+    as 'apply.<action>'; for 'Take' that includes waiting for a worker."""
+
+    # Image, ignore; emitted after each file
+    processed = pyqtSignal(object, bool)
+    # emitted once, even if cancelled
+    finished = pyqtSignal()
+
+
+    def __init__(self, jobs, dst, new_files, workers=None, stitch_dir=STITCH_DIR,
+                 compare_dir=COMPARE_DIR, hugin=True, renamed=None, timings=None, parent=None):
+        QObject.__init__(self, parent)
+        self.jobs = jobs
+        self.dst = dst
+        self.new_files = new_files
+        self.renamed = renamed if renamed is not None else {}
+        self.stitch_dir = stitch_dir
+        self.compare_dir = compare_dir
+        self.launch_hugin = hugin
+        self.timings = timings if timings is not None else Timings()
+
+        self.workers = workers
+        self.pool = None
+
+        self.cancelled = False
+        self.hugin = False
+        self.thread = Thread(target=self.run, name='batch', daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def run(self):
+        start = time.perf_counter()
+
+        try:
+            for img, action in self.jobs:  # already sorted by fname
+                if self.cancelled:
+                    logger.info('cancelled')
+                    break
+
+                done = self.apply(img, action)
+
+                if done is not None:
+                    # don't show the image anymore
+                    self.processed.emit(img, done and action in ('K', 'T', 'D', 'C', 'S'))
+
+            if self.pool is not None:
+                # wait for the resizes, unless we were cancelled
+                self.pool.shutdown(wait=True, cancel_futures=self.cancelled)
+
+            if self.hugin and self.launch_hugin:
+                subprocess.Popen([ 'hugin' ])
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.timings.add('apply', time.perf_counter() - start)
+            self.finished.emit()
+
+
+    def resize(self, img, src, dst):
+        if self.pool is None:
+            # don't fork, we have threads around
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+        start = time.perf_counter()
+        future = self.pool.submit(resize, src, dst)
+        future.add_done_callback(lambda future: self.resized(img, src, future, start))
+
+
+    def resized(self, img, src, future, start):
+        if future.cancelled():
+            return
+
+        self.timings.add('apply.T', time.perf_counter() - start)
+
+        e = future.exception()
+        if e is None:
+            self.processed.emit(img, True)
+        else:
+            logger.error("could not resize %s: %s", src, e)
+            # don't ignore it, so it can be tried again
+            self.processed.emit(img, False)
+
+
+    def apply(self, img, action):
+        """Returns whether it could be done, or None if it will be reported
+        later (see resize())."""
+        # it might have been renamed by a previous batch
+        src = self.renamed.get(img.path, img.path)
+        dst = os.path.join(self.dst, os.path.basename(img.path))
+
+        logger.debug((src, dst, action))
+        start = time.perf_counter()
+
+        try:
+            if src in self.new_files and action not in ('C', 'D'):
+                # rename
+                with self.timings.span('rename'):
+                    src = rename_file(src)
+
+                if src is not None:
+                    self.renamed[img.path] = src
+
+            if   action == 'K':
+                # Keep -> /gallery/foo, as-is
+                logger.info("%s -> %s", src, dst)
+                shutil.move(src, dst)
+
+            elif action == 'T':
+                # Take -> /gallery/foo, resized
+                self.resize(img, src, dst)
+
+                return None
+
+            elif action == 'S':
+                # Stitch -> 02-new/stitch
+                dst = os.path.join(self.stitch_dir, os.path.basename(src))
+                logger.info("%s -> %s", src, dst)
+                shutil.move(src, dst)
+                self.hugin = True
+
+            elif action == 'M':
+                # coMpare -> 03-cur
+                dst = os.path.join(self.compare_dir, os.path.basename(src))
+                logger.info("%s -> %s", src, dst)
+                shutil.move (src, dst)
+
+            elif action == 'C':
+                # Crop -> launch gwenview
+                os.system('gwenview %s' % src)
+
+                # asume the file was saved under a new name
+                # logger.info("%s -> %s", src, dst)
+                # shutil.move(src, dst)
+
+            elif action == 'D':
+                # Delete -> /dev/null
+                os.unlink(src)
+                logger.info("%s deleted", src)
+
+        except FileNotFoundError as e:
+            logger.info(e)
+            return False
+
+        if action is not None:
+            self.timings.add(f"apply.{action}", time.perf_counter() - start)
+
+        return True
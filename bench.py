@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+
+# headless benchmarks over a synthetic corpus; run it as
+#   ./bench.py --count 200 --output bench.json
+# and compare the JSON files between runs
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+
+# before importing anything from Qt
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication, QMainWindow
+from PyQt5.QtGui import QImage, QPainter, QColor, QLinearGradient
+from PyQt5.QtCore import QPointF, QRectF
+
+import gi
+gi.require_version('GExiv2', '0.10')
+from gi.repository import GExiv2, GLib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from timing import stats
+
+# mostly upright, some portraits
+orientations = [ '1' ] * 7 + [ '6', '8', '3' ]
+
+# what a Nikon writes, more or less
+nikon_tags = {
+    'Exif.Image.Make': 'NIKON CORPORATION',
+    'Exif.Image.Model': 'NIKON D7200',
+    'Exif.Photo.FocalLength': '350/10',
+    'Exif.Photo.FocalLengthIn35mmFilm': '52',
+    'Exif.Photo.FNumber': '56/10',
+    'Exif.Photo.ISOSpeedRatings': '200',
+    'Exif.Photo.ExposureBiasValue': '-1/3',
+    'Exif.Nikon3.Focus': 'AF-S  ',
+    'Exif.Nikon3.WhiteBalance': 'AUTO        ',
+    'Exif.Nikon3.NoiseReduction': 'OFF ',
+    'Exif.Nikon3.ActiveDLighting': '3',
+    'Exif.NikonPc.Name': 'STANDARD',
+    'Exif.NikonLd3.FocusDistance': '80',
+}
+exposure_times = [ '1/30', '1/125', '1/250', '1/1000', '2/1' ]
+
+
+def make_image(path, width, height, seed):
+    """Something with gradients and edges, so it doesn't compress to nothing."""
+    rng = random.Random(seed)
+    image = QImage(width, height, QImage.Format_RGB32)
+
+    painter = QPainter(image)
+    gradient = QLinearGradient(QPointF(0, 0), QPointF(width, height))
+    gradient.setColorAt(0, QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    gradient.setColorAt(1, QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    painter.fillRect(QRectF(0, 0, width, height), gradient)
+
+    for i in range(200):
+        painter.setBrush(QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        painter.drawEllipse(QRectF(rng.uniform(0, width), rng.uniform(0, height),
+                                   rng.uniform(10, width / 4), rng.uniform(10, height / 4)))
+    painter.end()
+
+    image.save(path, 'JPEG', 90)
+
+
+def make_corpus(card, count, width, height, seed):
+    """A camera card with count images. Shots come in bursts of up to 8 in
+    the same second, so the renames collide. Returns the paths."""
+    rng = random.Random(seed)
+    dir = os.path.join(card, 'DCIM', '100NIKON')
+    os.makedirs(dir)
+
+    date = datetime(2020, 11, 6, 10, 0, 0)
+    burst = 0
+    paths = []
+
+    for i in range(count):
+        if burst == 0:
+            burst = rng.choice([ 1, 1, 1, 2, 3, 8 ])
+            date += timedelta(seconds=rng.randrange(1, 600))
+        burst -= 1
+
+        path = os.path.join(dir, f"DSC_{i:04d}.JPG")
+        make_image(path, width, height, seed + i)
+
+        try:
+            metadata = GExiv2.Metadata(path)
+            for tag, value in nikon_tags.items():
+                metadata[tag] = value
+            metadata['Exif.Photo.DateTimeOriginal'] = date.strftime('%Y:%m:%d %H:%M:%S')
+            metadata['Exif.Image.Orientation'] = rng.choice(orientations)
+            metadata['Exif.Photo.ExposureTime'] = rng.choice(exposure_times)
+            metadata.save_file()
+        except GLib.Error as e:
+            print(f"could not write the metadata of {path}: {e}", file=sys.stderr)
+
+        paths.append(path)
+
+    return paths
+
+
+def make_digikam_db(names, seed):
+    """A stand in for digiKam's db, with ratings for most images."""
+    import digikam
+
+    rng = random.Random(seed)
+    digikam.metadata.create_all(digikam.engine)
+
+    session = digikam.Session()
+    for id, name in enumerate(names, 1):
+        session.add(digikam.Image(id=id, album=1, name=name, status=1, category=1))
+        if rng.random() < 0.8:
+            session.add(digikam.ImageInformation(image_id=id, rating=rng.randrange(6)))
+    session.commit()
+    session.close()
+
+
+def bench_import(card, mid, workers):
+    import workflow
+
+    start = time.perf_counter()
+    imported = workflow.import_files(card, mid, move=False, workers=workers)
+    elapsed = time.perf_counter() - start
+
+    size = sum(os.stat(path).st_size for path in imported)
+
+    return dict(files=len(imported), seconds=elapsed, files_per_second=len(imported) / elapsed,
+                mib_per_second=size / 1024 / 1024 / elapsed)
+
+
+def bench_rename(mid, work):
+    import rename_pictures
+
+    results = {}
+
+    # one by one, like batch.py does
+    dir = os.path.join(work, 'rename_file')
+    shutil.copytree(mid, dir)
+    samples = []
+    for name in sorted(os.listdir(dir)):
+        start = time.perf_counter()
+        rename_pictures.rename_file(os.path.join(dir, name))
+        samples.append(time.perf_counter() - start)
+    results['rename_file'] = stats(samples)
+
+    # all at once, like the command line does
+    dir = os.path.join(work, 'rename_files')
+    shutil.copytree(mid, dir)
+    srcs = [ os.path.join(dir, name) for name in sorted(os.listdir(dir)) ]
+    start = time.perf_counter()
+    rename_pictures.rename_files(srcs)
+    elapsed = time.perf_counter() - start
+    results['rename_files'] = dict(files=len(srcs), seconds=elapsed,
+                                   files_per_second=len(srcs) / elapsed)
+
+    return results
+
+
+def spin(app, condition, timeout=60):
+    """Process events until condition() is true. Returns whether it is."""
+    end = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > end:
+            return False
+
+        app.processEvents()
+        time.sleep(0.001)
+
+    return True
+
+
+def bench_filter(app, mid, work, steps, seed):
+    import filter
+
+    config = ConfigParser()
+    config.read_dict({
+        'Directories': { 'src': os.path.join(work, 'card'), 'mid': mid,
+                         'stitch': os.path.join(work, 'stitch'),
+                         'compare': os.path.join(work, 'compare') },
+        'Cache': { 'metadata_db': os.path.join(work, 'cache', 'metadata.db'),
+                   'hashes_db': os.path.join(work, 'cache', 'hashes.db') },
+        'Session': { 'journal': os.path.join(work, 'session.journal') },
+        'Apply': { 'hugin': 'no' },
+    })
+    os.makedirs(os.path.join(work, 'stitch'))
+    os.makedirs(os.path.join(work, 'compare'))
+    results = {}
+
+    win = QMainWindow()
+    win.resize(1920, 1080)
+
+    start = time.perf_counter()
+    view = filter.Filter(win, config, [])
+    win.setCentralWidget(view)
+    win.show()
+
+    spin(app, lambda: view.image is not None)
+    first_image = time.perf_counter()
+    # scan_finished() starts watching the directories
+    spin(app, lambda: len(view.watcher.dirs) > 0)
+    results['scan'] = dict(images=len(view.all_images), first_image_seconds=first_image - start,
+                           total_seconds=time.perf_counter() - start)
+
+    # let the metadata cache fill, like it would while we look at the first one
+    time.sleep(1)
+
+    moves = []
+    update_views = []
+    for i in range(steps):
+        start = time.perf_counter()
+        view.next_image()
+        # let the prefetcher deliver
+        app.processEvents()
+        moves.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        view.update_view()
+        update_views.append(time.perf_counter() - start)
+
+    results['move_index'] = stats(moves)
+    results['update_view'] = stats(update_views)
+
+    # compare a few, side by side
+    view.first_image()
+    for i in range(min(4, len(view.all_images))):
+        view.select_for_compare()
+
+    start = time.perf_counter()
+    view.compare()
+    results['compare'] = dict(images=len(view.compare_set), enter_seconds=time.perf_counter() - start)
+
+    flips = []
+    for i in range(steps):
+        start = time.perf_counter()
+        view.next_image()
+        app.processEvents()
+        flips.append(time.perf_counter() - start)
+    results['compare']['flip'] = stats(flips)
+
+    # back to all
+    view.apply()
+
+    # tag everything, with a mix of actions
+    rng = random.Random(seed)
+    counts = {}
+    for image in view.all_images:
+        action = rng.choice([ 'K', 'T', 'T', 'D', 'S', None ])
+        if action is not None:
+            view.set_action(image, action)
+            counts[action] = counts.get(action, 0) + 1
+
+    view.dst = os.path.join(work, 'gallery')
+    os.makedirs(view.dst)
+    # it would ask for the dst
+    view.new_dst = lambda *args: None
+
+    start = time.perf_counter()
+    view.apply()
+    finished = spin(app, lambda: view.batch is None, timeout=600)
+    elapsed = time.perf_counter() - start
+    results['apply'] = dict(actions=counts, seconds=elapsed, finished=finished,
+                            files_per_second=sum(counts.values()) / elapsed)
+
+    # the stages, from the view's own timings
+    results['stages'] = view.timings.stats()
+
+    view.prefetcher.shutdown()
+    view.metadata_cache.shutdown()
+    view.hash_index.shutdown()
+    view.tile_executor.shutdown(wait=False, cancel_futures=True)
+    view.rating_writer.stop()
+    view.close_session()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ananke over a synthetic corpus.')
+    parser.add_argument('-n', '--count', type=int, default=100, help='images in the corpus')
+    parser.add_argument('--size', default='3000x2000', help='size of the images')
+    parser.add_argument('--steps', type=int, default=50, help='moves in the navigation walk')
+    parser.add_argument('--workers', type=int, default=4, help='import workers')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dir', help='work here instead of in a temporary directory; it must not exist')
+    parser.add_argument('-o', '--output', default='-', help='where to write the JSON results')
+    opts = parser.parse_args()
+
+    width, height = ( int(x) for x in opts.size.split('x') )
+    if opts.output != '-':
+        # we chdir() later
+        opts.output = os.path.abspath(opts.output)
+
+    if opts.dir is not None:
+        work = os.path.abspath(opts.dir)
+        os.makedirs(work)
+    else:
+        work = tempfile.mkdtemp(prefix='ananke-bench-')
+
+    # before any of the threads that read the metadata start
+    GExiv2.initialize()
+
+    app = QApplication(sys.argv)
+
+    # digikam.py and rename_pictures.py use ByDate relative to the cwd
+    os.chdir(work)
+    os.makedirs('ByDate')
+
+    results = dict(date=datetime.now().isoformat(), python=platform.python_version(),
+                   machine=platform.machine(), cpus=os.cpu_count(),
+                   corpus=dict(count=opts.count, size=opts.size, seed=opts.seed))
+
+    card = os.path.join(work, 'card')
+    start = time.perf_counter()
+    make_corpus(card, opts.count, width, height, opts.seed)
+    results['corpus']['seconds'] = time.perf_counter() - start
+
+    mid = os.path.join(work, 'mid')
+    os.makedirs(mid)
+    results['import_files'] = bench_import(card, mid, opts.workers)
+    results.update(bench_rename(mid, work))
+
+    make_digikam_db(sorted(os.listdir(mid)), opts.seed)
+    results.update(bench_filter(app, mid, work, opts.steps, opts.seed))
+
+    if opts.dir is None:
+        shutil.rmtree(work)
+
+    text = json.dumps(results, indent=2)
+    if opts.output == '-':
+        print(text)
+    else:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
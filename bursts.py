@@ -0,0 +1,292 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+import struct
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from threading import Lock, Thread
+
+import numpy
+
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage, QImageReader
+
+from metadata_cache import file_key
+import exif
+
+import logging
+logger = logging.getLogger("bursts")
+
+# the images are hashed from a SIZE x SIZE decode in grays
+SIZE = 32
+
+
+def dct_matrix(n):
+    """The orthonormal DCT-II as a matrix, so a batch of images can be
+    transformed with two matrix products."""
+    k = numpy.arange(n)[:, None]
+    i = numpy.arange(n)[None, :]
+    matrix = numpy.cos(numpy.pi * (2 * i + 1) * k / (2 * n)) * numpy.sqrt(2 / n)
+    matrix[0] /= numpy.sqrt(2)
+
+    return matrix.astype(numpy.float32)
+
+
+def area_matrix(n, size):
+    """Averages size samples down to n, weighting each by how much of it
+    falls in each of the n."""
+    edges = numpy.linspace(0, size, n + 1)
+    lo = numpy.maximum(edges[:-1, None], numpy.arange(size)[None, :])
+    hi = numpy.minimum(edges[1:, None], numpy.arange(size)[None, :] + 1)
+    matrix = numpy.maximum(hi - lo, 0)
+
+    return (matrix / matrix.sum(axis=1, keepdims=True)).astype(numpy.float32)
+
+
+DCT = dct_matrix(SIZE)
+# dHash compares 9 columns in each of 8 rows
+ROWS = area_matrix(8, SIZE)
+COLUMNS = area_matrix(9, SIZE)
+
+
+def pack(bits):
+    """(N, 64) booleans -> (N, ) uint64."""
+    return numpy.packbits(bits, axis=1).view('>u8').reshape(-1).astype(numpy.uint64)
+
+
+def dhash(images):
+    """The difference hashes of a (N, SIZE, SIZE) array of images."""
+    small = ROWS @ images @ COLUMNS.T
+
+    return pack((small[:, :, 1:] > small[:, :, :-1]).reshape(-1, 64))
+
+
+def phash(images):
+    """The DCT based hashes of a (N, SIZE, SIZE) array of images."""
+    low = (DCT @ images @ DCT.T)[:, :8, :8].reshape(-1, 64)
+    # the DC term is just the brightness
+    median = numpy.median(low[:, 1:], axis=1, keepdims=True)
+
+    return pack(low > median)
+
+
+if hasattr(numpy, 'bitwise_count'):
+    popcount = numpy.bitwise_count
+else:
+    def popcount(values):
+        bits = numpy.unpackbits(numpy.ascontiguousarray(values).view(numpy.uint8))
+        return bits.reshape(-1, 64).sum(axis=1).reshape(values.shape)
+
+
+def load(path):
+    """Decode path for hashing. Returns the key (see file_key()), a
+    (SIZE, SIZE) array and the capture date as a timestamp, or None.
+
+    Runs in the workers."""
+    try:
+        key = file_key(path)
+    except OSError as e:
+        logger.info("can't hash %s: %s", path, e)
+        return None
+
+    reader = QImageReader(path)
+    # for JPEGs this is done while decoding, so it's cheap
+    reader.setScaledSize(QSize(SIZE, SIZE))
+    qimage = reader.read()
+    if qimage.isNull():
+        logger.info("can't hash %s: %s", path, reader.errorString())
+        return None
+
+    qimage = qimage.convertToFormat(QImage.Format_Grayscale8)
+    bits = qimage.constBits()
+    bits.setsize(qimage.bytesPerLine() * SIZE)
+    array = numpy.frombuffer(bits, numpy.uint8).reshape(SIZE, qimage.bytesPerLine())[:, :SIZE]
+
+    try:
+        # '2016:07:17 16:46:04', see read_image_date()
+        date = datetime.strptime(exif.read_date(path), '%Y:%m:%d %H:%M:%S').timestamp()
+    except (OSError, ValueError, TypeError, AttributeError, struct.error):
+        # cameras set it to when the shot was taken
+        date = os.stat(path).st_mtime
+
+    return key, array.astype(numpy.float32), date
+
+
+class HashIndex:
+    """Perceptual hashes (dHash and pHash) of the images and their capture
+    dates, to find bursts of near duplicates.
+
+    Like MetadataCache, they're cached in SQLite by path, size and mtime,
+    and fill() computes the missing ones in the background; group() finds
+    the burst around an image."""
+
+
+    def __init__(self, db_path, workers=2, batch_size=64, threshold=12, gap=2, window=4):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # the filler thread writes too
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER NOT NULL,
+                               mtime INTEGER NOT NULL,
+                               dhash INTEGER NOT NULL,
+                               phash INTEGER NOT NULL,
+                               date REAL NOT NULL
+                           )''')
+        self.db.commit()
+        self.lock = Lock()
+
+        # path -> (key, dhash, phash, date); loaded by load_all()
+        self.hashes = None
+
+        self.workers = workers
+        self.batch_size = batch_size
+        # the mean distance of both hashes, in bits, for two images to be
+        # near duplicates
+        self.threshold = threshold
+        # how far apart, in seconds, and in images, shots of a burst can be
+        self.gap = gap
+        self.window = window
+
+        # one per fill() running
+        self.executors = set()
+
+
+    def load_all(self):
+        with self.lock:
+            if self.hashes is not None:
+                return
+
+            rows = self.db.execute('SELECT path, size, mtime, dhash, phash, date FROM hashes').fetchall()
+            # they're stored signed, see compute()
+            hashes = numpy.array([ (row[3], row[4]) for row in rows ],
+                                 dtype=numpy.int64).reshape(-1, 2).view(numpy.uint64)
+            self.hashes = { row[0]: ((row[1], row[2]), d, p, row[5])
+                            for row, (d, p) in zip(rows, hashes) }
+
+
+    def missing(self, paths):
+        self.load_all()
+
+        missing = []
+        for path in paths:
+            entry = self.hashes.get(path)
+            try:
+                if entry is None or entry[0] != file_key(path):
+                    missing.append(path)
+            except OSError:
+                pass
+
+        return missing
+
+
+    def compute(self, paths, executor):
+        """Hash paths, all in one go, and store them."""
+        loaded = [ (path, result) for path, result in zip(paths, executor.map(load, paths))
+                   if result is not None ]
+        if len(loaded) == 0:
+            return
+
+        images = numpy.stack([ array for path, (key, array, date) in loaded ])
+        dhashes = dhash(images)
+        phashes = phash(images)
+
+        # SQLite's integers are signed
+        signed = numpy.stack([ dhashes, phashes ], axis=1).view(numpy.int64).tolist()
+
+        with self.lock:
+            for (path, (key, array, date)), d, p in zip(loaded, dhashes, phashes):
+                self.hashes[path] = (key, d, p, date)
+
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                [ (path, key[0], key[1], d, p, date)
+                                  for (path, (key, array, date)), (d, p) in zip(loaded, signed) ])
+            self.db.commit()
+
+
+    def fill(self, paths):
+        """Hash those paths not hashed yet in worker threads."""
+        thread = Thread(target=self.fill_thread, args=(list(paths), ),
+                        name='hash-fill', daemon=True)
+        thread.start()
+
+
+    def fill_thread(self, paths):
+        missing = self.missing(paths)
+        logger.debug("%d/%d to hash", len(missing), len(paths))
+        if len(missing) == 0:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix='hash')
+        with self.lock:
+            self.executors.add(executor)
+
+        try:
+            for i in range(0, len(missing), self.batch_size):
+                self.compute(missing[i:i + self.batch_size], executor)
+        except (CancelledError, RuntimeError):
+            # shutdown(); what's done is saved
+            pass
+        finally:
+            with self.lock:
+                self.executors.discard(executor)
+
+            executor.shutdown()
+
+
+    def group(self, paths, path):
+        """Return the paths of the burst path is in, out of paths (the images
+        around it), in the same order. Those not hashed yet are hashed now."""
+        missing = self.missing(paths)
+        if len(missing) > 0:
+            logger.debug("hashing %d now", len(missing))
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix='hash') as executor:
+                self.compute(missing, executor)
+
+        with self.lock:
+            entries = [ (other, self.hashes[other]) for other in paths if other in self.hashes ]
+
+        # in the order they were taken
+        entries.sort(key=lambda item: (item[1][3], item[0]))
+        found = [ other for other, entry in entries ]
+        if path not in found:
+            return [ path ]
+
+        dhashes = numpy.array([ entry[1] for other, entry in entries ], dtype=numpy.uint64)
+        phashes = numpy.array([ entry[2] for other, entry in entries ], dtype=numpy.uint64)
+        dates = numpy.array([ entry[3] for other, entry in entries ])
+
+        # union-find over the pairs of shots close in time and in looks
+        parents = list(range(len(found)))
+
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+
+            return i
+
+        for k in range(1, min(self.window, len(found) - 1) + 1):
+            distances = (popcount(dhashes[k:] ^ dhashes[:-k]) +
+                         popcount(phashes[k:] ^ phashes[:-k])) / 2
+            close = (distances <= self.threshold) & (dates[k:] - dates[:-k] <= self.gap)
+
+            for i in numpy.flatnonzero(close):
+                parents[root(int(i) + k)] = root(int(i))
+
+        group = root(found.index(path))
+        burst = { found[i] for i in range(len(found)) if root(i) == group }
+
+        return [ other for other in paths if other in burst ]
+
+
+    def shutdown(self):
+        with self.lock:
+            executors = list(self.executors)
+
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
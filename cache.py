@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+from collections import OrderedDict
+from threading import Lock
+
+import logging
+logger = logging.getLogger("cache")
+
+MiB = 1024 * 1024
+
+
+class ImageCache:
+    """A cache of decoded images with a byte budget per tier and LRU eviction.
+
+    Images decoded to fit the screen and at full resolution go to separate
+    tiers ('screen' and 'full'), so a few full resolution ones can't push out
+    all the screen sized ones. Pinned paths are never evicted, even if that
+    means going over budget.
+
+    Entries are decode()'s results. Workers put() into it, so it's locked."""
+
+
+    def __init__(self, screen_budget=512 * MiB, full_budget=1024 * MiB):
+        self.budgets = dict(screen=screen_budget, full=full_budget)
+        # path -> (QImage, QSize, GExiv2.Metadata), oldest first
+        self.tiers = dict(screen=OrderedDict(), full=OrderedDict())
+        self.resident = dict(screen=0, full=0)
+        self.pinned = set()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = Lock()
+
+
+    def get(self, tier, path):
+        with self.lock:
+            entries = self.tiers[tier]
+            entry = entries.get(path)
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                entries.move_to_end(path)
+
+            return entry
+
+
+    def __contains__(self, key):
+        tier, path = key
+
+        with self.lock:
+            return path in self.tiers[tier]
+
+
+    def put(self, tier, path, entry):
+        with self.lock:
+            entries = self.tiers[tier]
+
+            old = entries.pop(path, None)
+            if old is not None:
+                self.resident[tier] -= old[0].sizeInBytes()
+
+            entries[path] = entry
+            self.resident[tier] += entry[0].sizeInBytes()
+
+            self.evict(tier)
+
+
+    def remove(self, path):
+        """Drop path from all the tiers, for instance because the file changed."""
+        with self.lock:
+            for tier, entries in self.tiers.items():
+                entry = entries.pop(path, None)
+                if entry is not None:
+                    self.resident[tier] -= entry[0].sizeInBytes()
+
+
+    def evict(self, tier):
+        entries = self.tiers[tier]
+
+        for path in list(entries.keys()):
+            if self.resident[tier] <= self.budgets[tier]:
+                break
+
+            if path in self.pinned:
+                continue
+
+            entry = entries.pop(path)
+            self.resident[tier] -= entry[0].sizeInBytes()
+            logger.debug("evicted %s from %s", path, tier)
+
+
+    def pin(self, paths):
+        """Replace the set of pinned paths. Those that were pinned before can
+        be evicted again."""
+        with self.lock:
+            self.pinned = set(paths)
+
+            for tier in self.tiers.keys():
+                self.evict(tier)
+
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+
+        return self.hits / total
+
+
+    def stats(self):
+        tiers = ', '.join(f"{tier}: {len(self.tiers[tier])} images "
+                          f"{self.resident[tier] / MiB:.1f}/{self.budgets[tier] / MiB:.0f}MiB"
+                          for tier in self.tiers.keys())
+
+        return f"hit rate: {self.hit_rate():.1%} ({self.hits}/{self.hits + self.misses}); {tiers}"
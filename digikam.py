@@ -1,5 +1,9 @@
 #! /usr/bin/env python3
 
+import os
+import os.path
+from threading import Thread, Lock, Event
+
 from sqlalchemy import Column, Date, DateTime, Float, Index, Integer, LargeBinary, Table
 from sqlalchemy import Text, UniqueConstraint, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
@@ -91,6 +95,20 @@ class ImageInformation(Base):
     colorModel = Column('colorModel', Integer)
 
 
+def db_mtime():
+    path = engine.url.database
+
+    mtime = None
+    # with WAL, writes don't touch the db file until checkpoint
+    for file_name in (path, path + '-wal'):
+        try:
+            mtime = max(mtime or 0, os.stat(file_name).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+
+    return mtime
+
+
 def image(filename):
     try:
         image = session.query(Image).filter_by(name=filename)[0]
@@ -101,6 +119,240 @@ def image(filename):
     return image
 
 
+class RatingWriter:
+    """Buffers rating changes and writes them in batches in a background
+    thread, every `interval` seconds or as soon as `threshold` are pending.
+
+    They're written by Image.id, so only the row the rating was read from
+    changes, even if there are images with the same name in other albums.
+
+    flush() writes them right away; stop() too, and ends the thread.
+
+    It remembers how its writes changed the db's mtime, so Ratings doesn't
+    reload everything for changes it already has (see own_writes())."""
+
+
+    def __init__(self, interval=5, threshold=50, chunk_size=500):
+        self.interval = interval
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+
+        # image id -> (name, rating)
+        self.pending = {}
+        # the batch being written
+        self.writing = {}
+        self.lock = Lock()
+        # only one batch is written at a time
+        self.write_lock = Lock()
+        # db mtime before one of our commits -> after it
+        self.written = {}
+
+        self.wakeup = Event()
+        self.stopping = False
+        self.thread = Thread(target=self.run, name='rating-writer', daemon=True)
+        self.thread.start()
+
+
+    def set(self, image_id, name, rating):
+        with self.lock:
+            self.pending[image_id] = (name, rating)
+
+            if len(self.pending) >= self.threshold:
+                self.wakeup.set()
+
+
+    def get_pending(self):
+        """The ratings not written yet, as image id -> (name, rating)."""
+        with self.lock:
+            pending = dict(self.writing)
+            pending.update(self.pending)
+
+            return pending
+
+
+    def own_writes(self, mtime):
+        """The db's mtime after our writes that followed mtime, if nothing
+        else wrote in between."""
+        with self.lock:
+            while mtime in self.written:
+                mtime = self.written[mtime]
+
+        return mtime
+
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+                self.writing = batch
+
+            if len(batch) == 0:
+                return
+
+            # group them by rating, so it's one UPDATE per rating
+            by_rating = {}
+            for image_id, (name, rating) in batch.items():
+                by_rating.setdefault(rating, []).append(image_id)
+
+            write_session = Session()
+            try:
+                for rating, ids in by_rating.items():
+                    for i in range(0, len(ids), self.chunk_size):
+                        (write_session.query(ImageInformation)
+                                      .filter(ImageInformation.image_id.in_(ids[i:i + self.chunk_size]))
+                                      .update({ ImageInformation.rating: rating },
+                                              synchronize_session=False))
+
+                before = db_mtime()
+                write_session.commit()
+                after = db_mtime()
+
+                with self.lock:
+                    self.writing = {}
+
+                    if after != before:
+                        self.written[before] = after
+                        # we only need the latest ones
+                        while len(self.written) > 100:
+                            del self.written[next(iter(self.written))]
+            except:
+                write_session.rollback()
+
+                # put them back so they're written next time,
+                # unless they were changed in the meantime
+                with self.lock:
+                    batch.update(self.pending)
+                    self.pending = batch
+                    self.writing = {}
+
+                raise
+            finally:
+                write_session.close()
+
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+        self.flush()
+
+
+class Ratings:
+    """The ratings of a set of images, loaded in bulk, so looking them up
+    doesn't hit the database.
+
+    refresh() reloads them if the database changed since, for instance
+    because digiKam wrote to it. If a RatingWriter is given, set() writes
+    through it, and its writes don't count as changes."""
+
+
+    def __init__(self, names, writer=None, chunk_size=500):
+        self.names = sorted(set(names))
+        self.writer = writer
+        # SQLite has a limit on the amount of parameters in a query
+        self.chunk_size = chunk_size
+        self.ratings = {}
+        # name -> Image.id of the row the rating comes from
+        self.ids = {}
+        self.mtime = None
+
+        self.load()
+
+
+    def load(self):
+        self.mtime = db_mtime()
+        self.ratings, self.ids = self.query(self.names)
+
+
+    def add(self, names):
+        """Load the ratings of more images, leaving the rest as they are."""
+        names = set(names).difference(self.names)
+        if len(names) == 0:
+            return
+
+        self.names = sorted(names.union(self.names))
+
+        ratings, ids = self.query(sorted(names))
+        self.ratings.update(ratings)
+        self.ids.update(ids)
+
+
+    def query(self, names):
+        """Return the ratings of those names and the ids of their rows."""
+        ratings = {}
+        ids = {}
+
+        # use a new session so we don't see a stale snapshot of the db
+        load_session = Session()
+        try:
+            for i in range(0, len(names), self.chunk_size):
+                query = (load_session.query(Image.id, Image.name, ImageInformation.rating)
+                                     .join(ImageInformation, ImageInformation.image_id == Image.id)
+                                     .filter(Image.name.in_(names[i:i + self.chunk_size])))
+
+                for image_id, name, rating in query:
+                    # like image(), the first one wins
+                    if name not in ids:
+                        ids[name] = image_id
+                        ratings[name] = rating
+        except Exception as e:
+            print(e)
+        finally:
+            load_session.close()
+
+        if self.writer is not None:
+            # these are not in the db yet
+            wanted = set(names)
+            for image_id, (name, rating) in self.writer.get_pending().items():
+                if name in wanted:
+                    ids[name] = image_id
+                    ratings[name] = rating
+
+        return ratings, ids
+
+
+    def refresh(self):
+        """Reload if the database changed. Returns whether it did."""
+        if self.writer is not None:
+            # we already have what we wrote
+            self.mtime = self.writer.own_writes(self.mtime)
+
+        if db_mtime() == self.mtime:
+            return False
+
+        self.load()
+
+        return True
+
+
+    def get(self, name):
+        return self.ratings.get(name)
+
+
+    def set(self, name, rating):
+        self.ratings[name] = rating
+
+        if self.writer is not None:
+            self.writer.set(self.ids[name], name, rating)
+
+
+    def __contains__(self, name):
+        return name in self.ratings
+
+
 if __name__ == '__main__':
     images = session.query(Image).filter_by(name='2010-05-16T13.28.11.jpg').all()
     print(list(images))
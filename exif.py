@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+
+# just enough of the JPEG and TIFF/EXIF structures to move the metadata
+# around and read a few tags without parsing everything like GExiv2 does
+
+import mmap
+import struct
+
+SOI = b'\xff\xd8'
+# markers
+SOS = 0xda
+EOI = 0xd9
+APP0 = 0xe0
+APP1 = 0xe1
+APP13 = 0xed
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+TIFF_HEADERS = (b'II*\x00', b'MM\x00*')
+
+# tags
+DATE_TIME = 0x0132
+EXIF_IFD = 0x8769
+DATE_TIME_ORIGINAL = 0x9003
+PIXEL_X_DIMENSION = 0xa002
+PIXEL_Y_DIMENSION = 0xa003
+
+# type -> size in bytes
+type_sizes = { 1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8 }
+ASCII = 2
+SHORT = 3
+LONG = 4
+
+
+def jpeg_segments(f):
+    """Yield (marker, data) for the segments of the JPEG in the file object f
+    up to the image data (SOS). data does not include the marker or length."""
+    if f.read(2) != SOI:
+        raise ValueError('not a JPEG file')
+
+    while True:
+        if f.read(1) != b'\xff':
+            raise ValueError('bad JPEG marker')
+
+        marker = f.read(1)
+        # markers can be padded with any amount of 0xff
+        while marker == b'\xff':
+            marker = f.read(1)
+
+        if marker == b'':
+            raise ValueError('truncated JPEG file')
+
+        marker = marker[0]
+        if marker in (SOS, EOI):
+            return
+
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            # these have no data
+            continue
+
+        length, = struct.unpack('>H', f.read(2))
+        data = f.read(length - 2)
+        if len(data) != length - 2:
+            raise ValueError('truncated JPEG file')
+
+        yield marker, data
+
+
+def segment(marker, data):
+    return bytes((0xff, marker)) + struct.pack('>H', len(data) + 2) + data
+
+
+class Tiff:
+    """The TIFF structure used by EXIF, over a bytes-like object."""
+
+
+    def __init__(self, data):
+        self.data = data
+
+        order = bytes(data[:2])
+        if order == b'II':
+            self.order = '<'
+        elif order == b'MM':
+            self.order = '>'
+        else:
+            raise ValueError('not a TIFF header')
+
+        if self.unpack('H', 2) != 42:
+            raise ValueError('not a TIFF header')
+
+        self.first_ifd = self.unpack('I', 4)
+
+
+    def unpack(self, format, offset):
+        return struct.unpack_from(self.order + format, self.data, offset)[0]
+
+
+    def pack(self, format, offset, value):
+        struct.pack_into(self.order + format, self.data, offset, value)
+
+
+    def entries(self, ifd):
+        """Yield (tag, type, count, offset) for the entries in the IFD at ifd.
+        offset points to the value, either in the entry or out of it."""
+        for i in range(self.unpack('H', ifd)):
+            entry = ifd + 2 + 12 * i
+            tag = self.unpack('H', entry)
+            type = self.unpack('H', entry + 2)
+            count = self.unpack('I', entry + 4)
+
+            if type_sizes.get(type, 1) * count <= 4:
+                offset = entry + 8
+            else:
+                offset = self.unpack('I', entry + 8)
+
+            yield tag, type, count, offset
+
+
+    def find(self, ifd, tag):
+        """Return (type, count, offset) for tag in the IFD at ifd, or None."""
+        for entry_tag, type, count, offset in self.entries(ifd):
+            if entry_tag == tag:
+                return type, count, offset
+
+        return None
+
+
+    def read_int(self, type, offset):
+        if type == SHORT:
+            return self.unpack('H', offset)
+        elif type == LONG:
+            return self.unpack('I', offset)
+
+        raise ValueError(f"not an integer type: {type}")
+
+
+    def write_int(self, type, offset, value):
+        if type == SHORT:
+            self.pack('H', offset, value)
+        elif type == LONG:
+            self.pack('I', offset, value)
+        else:
+            raise ValueError(f"not an integer type: {type}")
+
+
+    def read_string(self, type, count, offset):
+        if type != ASCII:
+            raise ValueError(f"not a string type: {type}")
+
+        if offset + count > len(self.data):
+            raise ValueError('string out of bounds')
+
+        return bytes(self.data[offset:offset + count]).split(b'\x00', 1)[0].decode('ascii')
+
+
+    def exif_ifd(self):
+        """The offset of the EXIF IFD, or None."""
+        entry = self.find(self.first_ifd, EXIF_IFD)
+        if entry is None:
+            return None
+
+        type, count, offset = entry
+        return self.read_int(type, offset)
+
+
+    def date(self):
+        """DateTimeOriginal, or else DateTime, as written, or None."""
+        ifd = self.exif_ifd()
+        if ifd is not None:
+            entry = self.find(ifd, DATE_TIME_ORIGINAL)
+            if entry is not None:
+                return self.read_string(*entry)
+
+        entry = self.find(self.first_ifd, DATE_TIME)
+        if entry is not None:
+            return self.read_string(*entry)
+
+        return None
+
+
+def read_date(path):
+    """Return the date of the JPEG or TIFF based (like NEF) file in path (see
+    Tiff.date()) reading only the headers and the IFDs it needs. Raises
+    ValueError (or struct.error if it's truncated) for anything else."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+
+        if magic.startswith(SOI):
+            for marker, data in jpeg_segments(f):
+                if marker == APP1 and data.startswith(EXIF_HEADER):
+                    return Tiff(memoryview(data)[len(EXIF_HEADER):]).date()
+
+            return None
+
+        if magic in TIFF_HEADERS:
+            # only the pages with the IFDs are read
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return Tiff(data).date()
+
+    raise ValueError('not a JPEG or TIFF file')
+
+
+def set_pixel_dimensions(exif, width, height):
+    """Return a copy of the EXIF segment data (with its header) with the
+    image's dimensions changed."""
+    data = bytearray(exif)
+    tiff = Tiff(memoryview(data)[len(EXIF_HEADER):])
+
+    ifd = tiff.exif_ifd()
+    if ifd is not None:
+        for tag, value in ((PIXEL_X_DIMENSION, width), (PIXEL_Y_DIMENSION, height)):
+            entry = tiff.find(ifd, tag)
+            if entry is not None:
+                type, count, offset = entry
+                if type == LONG or value < 2**16:
+                    tiff.write_int(type, offset, value)
+
+    return bytes(data)
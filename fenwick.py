@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+
+
+class Fenwick:
+    """A Fenwick (binary indexed) tree over a list of counts: changing a count,
+    summing a prefix and finding where a prefix sum is reached are O(log n)."""
+
+
+    def __init__(self, counts=()):
+        # 1 based
+        self.tree = [ 0 ] + list(counts)
+
+        # build it in O(n)
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+
+    def add(self, index, delta):
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+
+    def prefix(self, index):
+        """The sum of the counts before index."""
+        total = 0
+        i = index
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+
+        return total
+
+
+    def total(self):
+        return self.prefix(len(self))
+
+
+    def find(self, k):
+        """The smallest index such that prefix(index + 1) > k; with counts of
+        0 and 1, that's the index of the (k + 1)th 1."""
+        index = 0
+        bit = 1 << (len(self).bit_length())
+
+        while bit > 0:
+            next = index + bit
+            if next < len(self.tree) and self.tree[next] <= k:
+                index = next
+                k -= self.tree[next]
+
+            bit >>= 1
+
+        return index
@@ -8,26 +8,39 @@
 import os
 import os.path
 import sys
+import time
 from collections import defaultdict, OrderedDict
-import shutil
 from configparser import ConfigParser
 from bisect import insort, bisect_left
-from fractions import Fraction
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
 from random import randint as random
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QGraphicsView, QGraphicsScene
 from PyQt5.QtWidgets import QGraphicsPixmapItem, QAction
 from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QLabel, QSpacerItem, QSizePolicy
 from PyQt5.QtWidgets import QFrame, QWidget, QFileDialog, QSplitter, QProgressBar
-from PyQt5.QtGui import QPixmap, QKeySequence, QBrush, QColor
-from PyQt5.QtCore import QTimer, QSize, Qt, QRectF, QMargins, QPoint
+from PyQt5.QtGui import QPixmap, QKeySequence, QBrush, QColor, QTransform
+from PyQt5.QtCore import QTimer, QSize, Qt, QMargins, QPoint, QPointF
 
 import gi
 gi.require_version('GExiv2', '0.10')
 from gi.repository import GExiv2, GLib
 
 import workflow
-from rename_pictures import rename_file, read_image_date
+from prefetch import Prefetcher, decode, preview
+from cache import ImageCache, MiB
+import batch
+from batch import Batch, resize
+from metadata_cache import MetadataCache, safe_panel_fields
+from bursts import HashIndex
+from tiles import TiledImage, TileCache
+from scanner import Scanner
+from fenwick import Fenwick
+from watcher import DirectoryWatcher
+from session import Session
+from timing import Timings, Profiler
+from rename_pictures import rename_file
 import digikam
 
 import logging
@@ -60,23 +73,53 @@ class Image:
     def __init__(self, path):
         self.path = path
         self.pixmap = None
+        self.preview = None
         self.metadata = None
+        # the size of the full image, not rotated
+        self.full_size = None
         self.size = None
         self.zoom = None
         self.position = None
         self.action = None
-        self.ignored = False
+        self._ignored = False
+        # the ImageLists it's in
+        self.lists = []
+        # part of the batch being applied
+        self.applying = False
 
 
-    def read(self):
-        if self.pixmap is None:
-            self.pixmap = QPixmap(self.path)
-            try:
-                self.metadata = GExiv2.Metadata(self.path)
-            except GLib.Error as e:
-                logger.info("Error loading %s's metadata: %s", self.path, e)
+    @property
+    def ignored(self):
+        return self._ignored
+
+
+    @ignored.setter
+    def ignored(self, ignored):
+        if ignored != self._ignored:
+            self._ignored = ignored
+
+            for images in self.lists:
+                images.set_live(self, not ignored)
+
+
+    def read(self, prefetcher=None, full=False):
+        """Decode the image. Unless full is True, the prefetcher might give us
+        one decoded at screen size, see scale()."""
+        if self.pixmap is None or (full and self.scale() < 1):
+            if prefetcher is not None:
+                qimage, full_size, metadata = prefetcher.get(self.path, full)
+            else:
+                qimage, full_size, metadata = decode(self.path)
+
+            self.pixmap = QPixmap.fromImage(qimage)
+            if metadata is None:
                 return False
 
+            # if we already have one (see read_preview()), it might have been
+            # modified (see rotate()), so keep it
+            if self.metadata is None:
+                self.metadata = metadata
+
             # the view will need three parameters:
             # rotation
             # size
@@ -84,22 +127,59 @@ class Image:
             # the first is needed to properly orient the view over the scene
             # the other two are needed for zoom, mostly
             # but the rotation defines the images size, so they're linked
-            self.size = self.pixmap.size()
+            self.full_size = full_size
+            self.preview = None
+            self.read_rotation()
+
+            return True
+
+        # already decoded; in compare mode they're kept (see Filter.compare())
+        return not self.pixmap.isNull()
+
+
+    def scale(self):
+        """The ratio between the decoded pixmap and the full image."""
+        if self.pixmap is None or self.pixmap.isNull():
+            return 0
+
+        return self.pixmap.width() / self.full_size.width()
+
 
+    def read_preview(self):
+        """Load the preview embedded in the metadata, so we can show something
+        while the full image is decoded."""
+        if self.metadata is None:
             try:
-                # try directly to get the tag, because sometimes get_tags() returns
-                # tags that don't actually are in the file
+                self.metadata = GExiv2.Metadata(self.path)
+            except GLib.Error as e:
+                logger.info("Error loading %s's metadata: %s", self.path, e)
+                return False
 
-                # this implicitly loads the metadata
-                self.exif_rotation = self.metadata['Exif.Image.Orientation']
-            except KeyError:
-                # guess :-/
-                logger.info("exif_rotation 'guessed'")
-                self.exif_rotation = '1'
+        qimage = preview(self.metadata)
+        if qimage is None:
+            return False
 
-            self.exif_rot_to_rot()
+        self.preview = QPixmap.fromImage(qimage)
+        self.full_size = QSize(self.metadata.get_pixel_width(),
+                               self.metadata.get_pixel_height())
+        self.read_rotation()
 
-            return True
+        return True
+
+
+    def read_rotation(self):
+        try:
+            # try directly to get the tag, because sometimes get_tags() returns
+            # tags that don't actually are in the file
+
+            # this implicitly loads the metadata
+            self.exif_rotation = self.metadata['Exif.Image.Orientation']
+        except KeyError:
+            # guess :-/
+            logger.info("exif_rotation 'guessed'")
+            self.exif_rotation = '1'
+
+        self.exif_rot_to_rot()
 
 
     def rotation(self):
@@ -147,12 +227,16 @@ class Image:
     def exif_rot_to_rot(self):
         rotation = self.rotation_in_degrees()
         if rotation in (90, 270):
-            self.size = QSize(self.size.height(), self.size.width())
+            self.size = QSize(self.full_size.height(), self.full_size.width())
+        else:
+            self.size = QSize(self.full_size)
 
 
     def release(self):
-        """Stop referencing the QPixmap object so its memory is released."""
+        """Stop referencing the QPixmap objects so their memory is released.
+        The decoded image stays in the cache, so reading it again is cheap."""
         self.pixmap = None
+        self.preview = None
 
 
     def __lt__(self, other):
@@ -160,49 +244,107 @@ class Image:
 
 
 class ImageList:
-    """A list of Images with a cursor."""
+    """A list of Images with a cursor.
+
+    The images that are not ignored (live) are counted in a Fenwick tree,
+    so moving over them, however many ignored ones are in between, is
+    O(log n). Images tell the lists they're in when they're (un)ignored."""
 
 
     def __init__(self):
         self.images = []
+        # to find out quickly if an image is already in
+        self.paths = set()
+        self.live = Fenwick()
         self.index = 0
         self.current_image = None
 
 
+    def rebuild(self):
+        self.live = Fenwick(0 if image.ignored else 1 for image in self.images)
+
+
+    def set_live(self, image, live):
+        index = bisect_left(self.images, image)
+        self.live.add(index, 1 if live else -1)
+
+
+    def live_count(self):
+        return self.live.total()
+
+
+    def live_index(self, rank):
+        """The index of the rank-th live image; negative ranks count from
+        the end."""
+        count = self.live.total()
+        if count == 0:
+            return self.index
+
+        return self.live.find(rank % count)
+
+
+    def rank(self, how_much):
+        """The rank of the live image how_much live images away from the
+        current one. If the current one is ignored, moving 0 means the next
+        live one."""
+        rank = self.live.prefix(self.index)
+
+        if self.images[self.index].ignored and how_much > 0:
+            # rank is already the next one's
+            how_much -= 1
+
+        return rank + how_much
+
+
     def move_index(self, to=None, how_much=0):
-        logger.debug(self.index)
         if to is not None:
             self.index = to
-        logger.debug(self.index)
 
-        if how_much != 0:
-            direction = how_much // abs(how_much)
-            how_much = abs(how_much)
-        else:
-            # find the next non-deleted image
-            direction = 1
-
-        moved = 0
-        logger.debug(len(self.images))
-        image = self.images[self.index]
+        count = self.live.total()
+        if count > 0:
+            # wrap around
+            self.index = self.live.find(self.rank(how_much) % count)
 
-        while moved < how_much or image.ignored:
-            logger.debug( (self.index, image.path, image.ignored, moved, how_much) )
-            self.index += direction
-            self.index %= len(self.images)
+        self.current_image = self.images[self.index]
+        logger.debug( (self.index, self.current_image.path, how_much) )
 
-            # skip deleted images
-            if not image.ignored:
-                moved += 1
 
-            image = self.images[self.index]
+    def neighbours(self, count, direction):
+        """Return up to count non ignored images after (direction=1) or
+        before (direction=-1) the current one, wrapping around."""
+        live = self.live.total()
+        if self.images[self.index].ignored:
+            # the next one is at rank(0)
+            first = self.rank(0) if direction > 0 else self.rank(0) - 1
+        else:
+            # the current one doesn't count
+            live -= 1
+            first = self.rank(0) + direction
 
-        logger.debug( (self.index, image.path, image.ignored, moved, how_much) )
-        self.current_image = image
+        return [ self.images[self.live.find((first + direction * i) % self.live.total())]
+                 for i in range(min(count, live)) ]
 
 
     def add(self, image):
         insort(self.images, image)
+        self.paths.add(image.path)
+        image.lists.append(self)
+        self.rebuild()
+
+
+    def add_many(self, images):
+        """Add a sorted list of images, keeping the cursor on the current one."""
+        self.images.extend(images)
+        # it's made of two sorted runs, so this is a merge
+        self.images.sort()
+
+        for image in images:
+            self.paths.add(image.path)
+            image.lists.append(self)
+        self.rebuild()
+
+        if self.current_image is not None:
+            self.index = bisect_left(self.images, self.current_image)
 
 
     def remove(self, item=None):
@@ -220,8 +362,40 @@ class ImageList:
         self.move_index()
 
 
+    def find(self, path):
+        """Return the index of the image with that path, or None."""
+        if path not in self.paths:
+            return None
+
+        return bisect_left(self.images, Image(path))
+
+
+    def in_dir(self, dir):
+        """Return the images directly in dir."""
+        prefix = dir + os.sep
+        index = bisect_left(self.images, Image(prefix))
+        found = []
+
+        # all the paths under dir are together
+        while index < len(self.images) and self.images[index].path.startswith(prefix):
+            image = self.images[index]
+            if os.path.dirname(image.path) == dir:
+                found.append(image)
+
+            index += 1
+
+        return found
+
+
     def clear(self):
+        for image in self.images:
+            image.lists.remove(self)
+
         self.images.clear()
+        self.paths.clear()
+        self.rebuild()
+        self.index = 0
+        self.current_image = None
 
 
     def __len__(self):
@@ -249,28 +423,101 @@ def catch(method):
     return wrapped
 
 
+def place_pixmap(item, image):
+    """Show the image's pixmap, or its preview, in the QGraphicsPixmapItem."""
+    if image.pixmap is not None:
+        pixmap = image.pixmap
+    else:
+        pixmap = image.preview
+
+    item.setPixmap(pixmap)
+
+    # the scene is always in the full image's coordinates, so zoom and
+    # positions don't depend on the resolution of what we're showing
+    if pixmap.isNull():
+        item.setTransform(QTransform())
+    else:
+        item.setTransform(QTransform.fromScale(image.full_size.width() / pixmap.width(),
+                                               image.full_size.height() / pixmap.height()))
+
+
+class View(QGraphicsView):
+    """A QGraphicsView that times its painting."""
+
+    def __init__(self, scene, parent, timings):
+        QGraphicsView.__init__(self, scene, parent)
+        self.timings = timings
+
+        self.setFrameShadow(QFrame.Plain)
+        self.setFrameStyle(QFrame.NoFrame)
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy  (Qt.ScrollBarAlwaysOff)
+
+        brush = QBrush(QColor(20, 20, 20))
+        brush.setStyle(Qt.SolidPattern)
+        self.setBackgroundBrush(brush)
+
+
+    def paintEvent(self, event):
+        with self.timings.span('paint'):
+            QGraphicsView.paintEvent(self, event)
+
+
+    def center(self):
+        """The point of the scene in the center of the view."""
+        view_size = self.size()
+        return self.mapToScene(QPoint(view_size.width() // 2, view_size.height() // 2))
+
+
+class Pane(View):
+    """One of the views next to the main one in compare mode, showing
+    another image of the compare set. Filter keeps its zoom and position in
+    sync with the main view's, see Filter.sync_panes()."""
+
+    def __init__(self, parent, timings):
+        View.__init__(self, QGraphicsScene(), parent, timings)
+        self.pixmap_view = QGraphicsPixmapItem()
+        self.scene().addItem(self.pixmap_view)
+        self.image = None
+
+
+    def set_image(self, image):
+        self.image = image
+        self.set_pixmap()
+
+
+    def set_pixmap(self):
+        place_pixmap(self.pixmap_view, self.image)
+        self.scene().setSceneRect(self.pixmap_view.sceneBoundingRect())
+
+
+    def sync(self, zoom_level, center):
+        # like the main view, 'undo' the image's rotation
+        self.setTransform(QTransform().rotate(-self.image.rotation_in_degrees()).scale(zoom_level, zoom_level))
+        self.centerOn(center)
+
+
+    def clear(self):
+        self.image = None
+        self.pixmap_view.setPixmap(QPixmap())
+
+
+def not_applying(method):
+    """Don't touch images that are part of the batch being applied."""
+    def wrapped(self, *args, **kwargs):
+        if self.image is not None and self.image.applying:
+            logger.warning("%s is being applied", self.image.path)
+        else:
+            return method(self, *args, **kwargs)
+
+    return wrapped
+
+
 class Filter(QWidget):
     label_map = { 'K': 'Keep', 'T': 'Take', 'S': 'Stitch', 'M': 'Compare',
                   'C': 'Crop', 'D': 'Delete', None: '' }
 
-    # see https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8128
-    multiple_exposure_map = {
-        '0': 'Off',
-        # '1': 'Multiple Exposure',
-        '1': 'Manual',
-        '2': 'Image Overlay',
-        '3': 'HDR',
-    }
-
-    active_dlightning_map = {
-            '0': 'Off',
-        '65535': 'Auto',
-            '7': 'Extra High',
-            '5': 'High',
-            '3': 'Normal',
-            '1': 'Low',
-    }
-
     def __init__(self, parent, config, new_files):
         QWidget.__init__(self, parent)
         self.zoom_level = 1.0
@@ -283,13 +530,98 @@ class Filter(QWidget):
         self.images = self.all_images
         self.comparing = False
         self.random = False
+        self.batch = None
+        # None means one per CPU
+        self.resize_workers = config.getint('Apply', 'workers', fallback=None)
+        self.hugin = config.getboolean('Apply', 'hugin', fallback=True)
+        self.stitch_dir = config.get('Directories', 'stitch', fallback=batch.STITCH_DIR)
+        self.compare_dir = config.get('Directories', 'compare', fallback=batch.COMPARE_DIR)
+
+        # how many images to show side by side in compare mode
+        self.panes_count = min(max(config.getint('Compare', 'panes', fallback=2), 1), 4)
+
+        # see timing.py
+        self.timings = Timings(config.getint('Timing', 'samples', fallback=1000))
+        self.timings_path = config.get('Timing', 'file',
+                                       fallback=os.path.expanduser('~/.cache/ananke/timings.json'))
+        self.profiler = Profiler(config.get('Timing', 'profile',
+                                            fallback=os.path.expanduser('~/.cache/ananke/profile.pstats')))
 
         self.buildUI(parent)
 
+        # budgets are in MiB
+        self.cache = ImageCache(config.getint('Cache', 'screen_budget', fallback=512) * MiB,
+                                config.getint('Cache', 'full_budget', fallback=1024) * MiB)
+        self.prefetcher = Prefetcher(self.cache,
+                                     config.getint('Prefetch', 'ahead', fallback=4),
+                                     config.getint('Prefetch', 'behind', fallback=1),
+                                     config.getint('Prefetch', 'workers', fallback=2),
+                                     self.timings, self)
+        self.prefetcher.decoded.connect(self.image_decoded)
+
+        # images bigger than this, in megapixels, are never decoded at full
+        # resolution, but shown by tiles; see show_tiles()
+        self.tiles_threshold = config.getint('Tiles', 'threshold', fallback=50) * 1000000
+        self.tile_cache = TileCache(config.getint('Tiles', 'budget', fallback=512) * MiB)
+        self.tile_source_budget = config.getint('Tiles', 'source_budget', fallback=256) * MiB
+        self.tile_executor = ThreadPoolExecutor(max_workers=config.getint('Tiles', 'workers', fallback=2),
+                                                thread_name_prefix='tiles')
+        self.tiled = None
+
+        db_path = config.get('Cache', 'metadata_db',
+                             fallback=os.path.expanduser('~/.cache/ananke/metadata.db'))
+        self.metadata_cache = MetadataCache(db_path, config.getint('Cache', 'metadata_workers',
+                                                                   fallback=2))
+
+        # see compare_burst()
+        self.hash_index = HashIndex(config.get('Cache', 'hashes_db',
+                                               fallback=os.path.expanduser('~/.cache/ananke/hashes.db')),
+                                    config.getint('Bursts', 'workers', fallback=1),
+                                    threshold=config.getint('Bursts', 'threshold', fallback=12),
+                                    gap=config.getfloat('Bursts', 'gap', fallback=2),
+                                    window=config.getint('Bursts', 'window', fallback=4))
+        # how many images before and after the current one can be in its burst
+        self.burst_size = config.getint('Bursts', 'max_size', fallback=50)
+
+        self.rating_writer = digikam.RatingWriter(config.getint('Digikam', 'write_interval', fallback=5),
+                                                  config.getint('Digikam', 'write_threshold', fallback=50))
+
+        # filled as they're found, see scanned()
+        self.ratings = digikam.Ratings([], self.rating_writer)
+
+        self.scanner = Scanner(batch_size=config.getint('Scan', 'batch_size', fallback=1000),
+                               workers=config.getint('Scan', 'workers', fallback=1),
+                               parent=self)
+        self.scanner.found.connect(self.scanned)
+        self.scanner.finished.connect(self.scan_finished)
+
+        # the state of the last session; see scanned()
+        self.session = Session(config.get('Session', 'journal',
+                                          fallback=os.path.abspath(config['Directories']['mid']) + '.journal'))
+        self.state = self.session.replay()
+        self.session.open(self.state)
+        # the paths found by the scanner, as opposed to the ones in the listing
+        self.found_paths = set()
+
+        # see directories_changed()
+        self.watcher = DirectoryWatcher(config.getint('Watch', 'delay', fallback=500), self)
+        self.watcher.changed.connect(self.directories_changed)
+        # the ones that changed while a batch was applied
+        self.changed_dirs = set()
+        self.started = time.time_ns()
+        # path -> mtime
+        self.mtimes = {}
+
         self.src = config['Directories']['mid']
         self.dst = os.getcwd()
         self.scan(self.src)
+
+        self.ratings_timer = QTimer(self)
+        self.ratings_timer.timeout.connect(self.refresh_ratings)
+        self.ratings_timer.start(config.getint('Digikam', 'refresh', fallback=5) * 1000)
         self.new_files = new_files
+        # path -> the name the batch gave it, see Batch
+        self.renamed = {}
 
         self.image = None
 
@@ -303,12 +635,51 @@ class Filter(QWidget):
         self.dir_dialog.setOption(QFileDialog.ShowDirsOnly)
         self.dir_dialog.setAcceptMode(QFileDialog.AcceptSave)
 
+        self.overlay_timer = QTimer(self)
+        self.overlay_timer.timeout.connect(self.update_overlay)
+        if config.getboolean('Timing', 'overlay', fallback=False):
+            self.toggle_overlay()
+
 
     @catch
     def toggle_random(self, *args):
         self.random = not self.random
 
 
+    @catch
+    def toggle_overlay(self, *args):
+        if self.overlay.isVisible():
+            self.overlay_timer.stop()
+            self.overlay.hide()
+        else:
+            self.update_overlay()
+            self.overlay.show()
+            self.overlay_timer.start(1000)
+
+
+    @catch
+    def update_overlay(self):
+        text = self.timings.text()
+        if self.profiler.running():
+            text += '\n[profiling]'
+
+        self.overlay.setText(text)
+        self.overlay.adjustSize()
+
+
+    @catch
+    def dump_timings(self, *args):
+        self.timings.dump(self.timings_path)
+
+
+    @catch
+    def toggle_profiler(self, *args):
+        self.profiler.toggle()
+
+        if self.overlay.isVisible():
+            self.update_overlay()
+
+
     def buildUI(self, parent):
         # left labels
         self.splitter = QSplitter(self)
@@ -342,18 +713,25 @@ class Filter(QWidget):
         self.pixmap_view = QGraphicsPixmapItem()
         self.scene.addItem(self.pixmap_view)
 
-        self.view = QGraphicsView(self.scene, parent)
-        self.view.setFrameShadow(QFrame.Plain)
-        self.view.setFrameStyle(QFrame.NoFrame)
-        self.view.setDragMode(QGraphicsView.ScrollHandDrag)
-        self.view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.view.setVerticalScrollBarPolicy  (Qt.ScrollBarAlwaysOff)
+        self.view = View(self.scene, parent, self.timings)
+        self.view.show()
 
-        brush = QBrush(QColor(20, 20, 20))
-        brush.setStyle(Qt.SolidPattern)
-        self.view.setBackgroundBrush(brush)
+        # in compare mode, up to 3 more images next to the main one
+        self.panes = [ Pane(self, self.timings) for i in range(3) ]
+        for pane in self.panes:
+            pane.hide()
 
-        self.view.show()
+        # keep them centered on the same point, see pan()
+        self.syncing = False
+        for view in [ self.view ] + self.panes:
+            view.horizontalScrollBar().valueChanged.connect(lambda value, view=view: self.pan(view))
+            view.verticalScrollBar().valueChanged.connect(lambda value, view=view: self.pan(view))
+
+        # timings, see toggle_overlay()
+        self.overlay = QLabel(self.view)
+        self.overlay.setStyleSheet('QLabel { font-family: monospace; color: white; '
+                                   'background-color: rgba(0, 0, 0, 160); padding: 4px; }')
+        self.overlay.hide()
 
         # "status bar"
         self.fname = QLabel(self)
@@ -374,12 +752,20 @@ class Filter(QWidget):
         status_bar.addWidget(self.tag_view)
         status_bar.addWidget(self.pbar)
 
+        # all the same width
+        views = QHBoxLayout()
+        views.addWidget(self.view, 1)
+        for pane in self.panes:
+            views.addWidget(pane, 1)
+
         w = QWidget(self.splitter)
 
         v = QVBoxLayout(w)
         v.setContentsMargins(QMargins(0, 0, 0, 0))
-        v.addWidget(self.view)
+        v.addLayout(views)
         v.addLayout(status_bar)
+        # see layout_panes()
+        self.views_layout = v
 
         self.splitter.setSizes([165, 1435])
 
@@ -412,11 +798,18 @@ class Filter(QWidget):
                 (Qt.Key_U, self.untag),
                 (Qt.CTRL + Qt.Key_X, self.expunge),
                 (Qt.Key_Return, self.apply),
+                (Qt.Key_Escape, self.cancel_apply),
 
                 (Qt.CTRL + Qt.Key_M, self.compare),
+                (Qt.Key_B, self.compare_burst),
+                (Qt.Key_N, self.cycle_panes),
                 (Qt.CTRL + Qt.Key_O, self.new_src),
                 (Qt.CTRL + Qt.Key_S, self.save),
 
+                (Qt.CTRL + Qt.Key_I, self.toggle_overlay),
+                (Qt.CTRL + Qt.SHIFT + Qt.Key_I, self.dump_timings),
+                (Qt.CTRL + Qt.Key_P, self.toggle_profiler),
+
                 (Qt.Key_0, lambda *ignore: self.set_rating(-1)),
                 (Qt.Key_1, lambda *ignore: self.set_rating( 1)),
                 (Qt.Key_2, lambda *ignore: self.set_rating( 2)),
@@ -434,13 +827,11 @@ class Filter(QWidget):
     @catch
     def set_rating(self, rating):
         name = os.path.basename(self.image.path)
-        image = digikam.image(name)
-
-        if image is not None:
-            logger.debug("%s: %d", name, image.info[0].rating)
-            image.info[0].rating = rating
-            digikam.session.commit()
 
+        if name in self.ratings:
+            logger.debug("%s: %d", name, self.ratings.get(name))
+            # this is written to the db in the background
+            self.ratings.set(name, rating)
             self.update_rating(name)
 
 
@@ -448,22 +839,220 @@ class Filter(QWidget):
     def scan(self, src):
         logger.debug('scanning %r', src)
 
-        total = 0
-        count = 0
+        listing = self.session.load_listing()
+        if listing is not None:
+            # show what we had the last time while we scan again
+            QTimer.singleShot(0, lambda: self.scanned(listing, listed=True))
+
+        # we don't know how many there are
+        self.pbar.setRange(0, 0)
+        self.found_paths = set()
+        self.scanner.start(src)
 
-        for r, dirs, files in os.walk(os.path.abspath(src)):
-            total += len(files)
-            self.pbar.setRange(1, total)
 
-            for name in files:
-                count += 1
-                self.pbar.setValue(count)
+    @catch
+    def scanned(self, paths, listed=False):
+        if not listed:
+            self.found_paths.update(paths)
 
-                if name[-4:].lower() in ('.jpg', '.png'):
-                    # logger.info('found %s',  name)
-                    self.images.add(Image(os.path.join(r, name)))
+        new = [ Image(path) for path in paths if path not in self.all_images.paths ]
+        for image in new:
+            self.restore(image)
 
-        self.pbar.reset()
+        self.all_images.add_many(new)
+        # so they can be rated before the scan finishes
+        self.ratings.add(os.path.basename(image.path) for image in new)
+
+        if self.image is None and len(self.all_images) > 0:
+            # first paint, don't wait for the rest
+            self.restore_cursor()
+
+
+    def restore(self, image):
+        """Restore the state the image had in the last session."""
+        action = self.state['actions'].get(image.path)
+        if action is not None:
+            image.action = action
+
+            if action == 'M':
+                self.compare_set.add(image)
+            else:
+                self.tagged_count += 1
+
+        if image.path in self.state['ignored']:
+            image.ignored = True
+
+        position = self.state['positions'].get(image.path)
+        if position is not None:
+            self.image_positions[image.path] = QPointF(*position)
+
+
+    def restore_cursor(self):
+        if self.state['comparing'] and len(self.compare_set) > 0:
+            self.comparing = True
+            self.images = self.compare_set
+            self.decode_compare_set()
+
+        index = None
+        if self.state['cursor'] is not None:
+            index = self.images.find(self.state['cursor'])
+
+        if index is None:
+            self.first_image()
+        else:
+            self.move_index(to=index)
+
+
+    @catch
+    def scan_finished(self, total):
+        logger.info('found %d images', total)
+
+        if self.batch is None:
+            self.pbar.reset()
+
+        # so update_view() doesn't have to parse them
+        self.metadata_cache.fill(image.path for image in self.all_images)
+        # so compare_burst() doesn't have to decode them
+        self.hash_index.fill(image.path for image in self.all_images)
+
+        # the images in the listing that are gone
+        for image in self.all_images:
+            if image.path not in self.found_paths and not image.ignored:
+                logger.info("%s is gone", image.path)
+                image.ignored = True
+
+                if image.action is not None and image.action != 'M':
+                    self.tagged_count -= 1
+
+        if self.image is not None and self.image.ignored:
+            self.move_index(to=self.images.index)
+
+        self.session.save_listing(sorted(self.found_paths))
+        # forget the files that are gone
+        self.session.compact(lambda path: path in self.found_paths)
+
+        # from now on, follow the changes
+        self.watcher.watch(self.scanner.dirs)
+
+
+    @catch
+    def directories_changed(self, dirs):
+        """Find the images added, removed or modified in dirs by listing just
+        them and comparing with what we have.
+
+        While a batch is applied, this waits for it to finish, so the files it
+        renames are not taken for new ones, see batch_finished()."""
+        if self.batch is not None:
+            self.changed_dirs.update(dirs)
+            return
+
+        # renamed by a batch but still here, because they failed
+        applied = set(self.renamed.values())
+        added = []
+        reload = False
+        # path -> mtime, from the listing, so we don't stat them again
+        mtimes = {}
+
+        for dir in dirs:
+            try:
+                paths, subdirs = self.scanner.list_dir(dir, mtimes)
+            except OSError:
+                # it was removed
+                paths, subdirs = [], []
+
+            paths = set(paths)
+
+            for image in self.all_images.in_dir(dir):
+                if image.path not in paths:
+                    if not image.ignored and image.path not in self.renamed:
+                        logger.info("%s was removed", image.path)
+                        image.ignored = True
+                        reload = self.forget(image) or reload
+                else:
+                    paths.remove(image.path)
+
+                    if self.modified(image.path, mtimes.get(image.path)):
+                        logger.info("%s was modified", image.path)
+                        reload = self.forget(image) or reload
+
+            # what's left is new
+            added.extend(paths)
+
+            for subdir in subdirs:
+                if subdir not in self.watcher.dirs:
+                    start = len(self.scanner.dirs)
+                    added.extend(self.scanner.walk(subdir))
+                    self.watcher.watch(self.scanner.dirs[start:])
+
+        added = [ path for path in added if path not in applied ]
+        if len(added) > 0:
+            logger.info("%d images added", len(added))
+            for path in added:
+                # so they're not taken for modified the next time
+                self.modified(path, mtimes.get(path))
+
+            self.all_images.add_many(sorted(Image(path) for path in added))
+
+            self.metadata_cache.fill(added)
+            self.hash_index.fill(added)
+            self.ratings.add(os.path.basename(path) for path in added)
+
+            if self.image is None:
+                self.first_image()
+
+        if reload:
+            # move away if it was removed, read it again if it was modified
+            self.move_index(to=self.images.index)
+
+
+    def modified(self, path, mtime=None):
+        """Whether the file changed since we last looked. The first time,
+        whether it changed since we started. mtime is the file's, if we
+        already have it."""
+        if mtime is None:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                return False
+
+        old = self.mtimes.get(path)
+        self.mtimes[path] = mtime
+
+        if old is None:
+            return mtime > self.started
+
+        return mtime != old
+
+
+    def forget(self, image):
+        """Drop the decoded image and its metadata. Returns whether it's the
+        one on screen."""
+        self.prefetcher.forget(image.path)
+        self.tile_cache.forget(image.path)
+        image.metadata = None
+
+        if image is self.image:
+            return True
+
+        image.release()
+
+        return False
+
+
+    def close_session(self):
+        """Forget the files we moved away or deleted, so a new file with the
+        same name doesn't come back ignored."""
+        gone = { image.path for image in self.all_images
+                 if image.ignored and not os.path.exists(image.path) }
+
+        if len(gone) > 0:
+            listing = self.session.load_listing()
+            if listing is not None:
+                self.session.save_listing([ path for path in listing if path not in gone ])
+
+            self.session.compact(lambda path: path not in gone)
+
+        self.session.close()
 
 
     @catch
@@ -500,60 +1089,183 @@ class Filter(QWidget):
         self.view.scale(scale, scale)
 
         self.zoom_level = zoom_level
+        self.sync_panes()
 
 
     @catch
     def move_index(self, to=None, how_much=0):
         # images might fail to load (for instance, the file was removed
-        # while we were running, and we don't have inotify support yet)
-        # so also iterate until we can find one that loads
-        print(f"{to}:{how_much}")
+        # while we were running, and directories_changed() didn't catch it
+        # yet) so also iterate until we can find one that loads
+        logger.debug("%s:%s", to, how_much)
+        start = time.perf_counter()
         finished = to is None and how_much == 0
 
+        if how_much != 0:
+            direction = how_much // abs(how_much)
+        else:
+            direction = 0
+
         while not finished:
             if self.image is not None:
                 self.save_position()
-                self.image.release()
+                # in compare mode they're kept decoded, see compare()
+                if not self.comparing:
+                    self.image.release()
 
             if not self.random:
                 index = self.images.move_index(to, how_much)
             else:
-                to = random(0, len(self.images) - 1)
+                to = self.images.live_index(random(0, max(self.images.live_count() - 1, 0)))
                 index = self.images.move_index(to)
 
             self.image = self.images.current_image
-            finished = self.image.read()
+            # the watcher doesn't tell us about files rewritten in place
+            if self.modified(self.image.path):
+                logger.info("%s was modified", self.image.path)
+                self.forget(self.image)
+                self.image.release()
+
+            # what's on screen or about to be compared stays in the cache
+            self.cache.pin([ self.image.path ] + [ image.path for image in self.compare_set ])
+
+            # decode the next ones while we look at this one
+            # in random mode we can't guess which one is next
+            self.prefetcher.size = self.view.size() * self.view.devicePixelRatioF()
+            with self.timings.span('prefetch'):
+                self.prefetcher.update(self.images, direction, neighbours=not self.random)
+
+            if (    self.image.pixmap is None
+                and not self.prefetcher.ready(self.image.path)
+                and self.read_preview()):
+                # show the preview, image_decoded() will replace it
+                finished = True
+            else:
+                finished = self.read()
 
             if not finished:
                 self.image.ignored = True
 
             logger.info((self.image.path, finished))
 
+        self.session.cursor(self.image.path)
+        self.show_image()
+        self.timings.add('move_index', time.perf_counter() - start)
 
 
-        self.show_image()
+    @catch
+    def image_decoded(self, path, full):
+        for pane in self.panes:
+            if pane.image is not None and pane.image.path == path:
+                if full and pane.image.scale() < 1 and self.read(full=True, image=pane.image):
+                    pane.set_pixmap()
+
+        if self.image is None or self.image.path != path:
+            # not the one we're waiting for
+            return
+
+        if full:
+            if self.image.scale() < 1 and self.read(full=True):
+                self.set_pixmap()
+        elif self.image.pixmap is None:
+            if self.read():
+                # don't use show_image(), we don't want to move the view
+                self.set_pixmap()
+                self.ensure_resolution()
+            else:
+                self.image.ignored = True
+                self.next_image()
+
+
+    def read(self, full=False, image=None):
+        if image is None:
+            image = self.image
+
+        # this includes waiting for the prefetcher; the decode itself is 'decode'
+        with self.timings.span('read'):
+            return image.read(self.prefetcher, full)
+
+
+    def read_preview(self):
+        with self.timings.span('read_preview'):
+            return self.image.read_preview()
 
 
     @catch
-    def view_position(self):
-        view_size = self.view.size()
-        center = QPoint(view_size.width() // 2, view_size.height() // 2)
-        position = self.view.mapToScene(center)
+    def ensure_resolution(self):
+        """If the decoded image is too small for the current zoom (we switched
+        to native resolution or rotated it), decode it at full resolution."""
+        if self.image.pixmap is None:
+            # still showing the preview
+            return
+
+        needed = self.zoom_level * self.view.devicePixelRatioF()
+        images = [ self.image ] + [ pane.image for pane in self.panes if pane.image is not None ]
+
+        for image in images:
+            # allow for rounding errors in the decoded size
+            if image.pixmap is not None and image.scale() * 1.01 < min(needed, 1):
+                logger.debug("%s: %f < %f", image.path, image.scale(), needed)
+
+                if not self.is_huge(image):
+                    self.prefetcher.request(image.path, full=True)
+                elif image is self.image:
+                    self.show_tiles()
+
+
+    def is_huge(self, image):
+        return image.full_size.width() * image.full_size.height() > self.tiles_threshold
+
+
+    def show_tiles(self):
+        """Show the image by tiles over the screen sized one, decoding only
+        the ones in view, at the resolution needed."""
+        if self.tiled is None:
+            self.tiled = TiledImage(self.image.path, self.image.full_size, self.tile_executor,
+                                    self.tile_cache, budget=self.tile_source_budget,
+                                    timings=self.timings)
+            # over the pixmap
+            self.tiled.setZValue(1)
+            self.scene.addItem(self.tiled)
+
+        # below this, the pixmap is enough
+        self.tiled.min_scale = self.image.scale()
+        self.tiled.update()
 
-        return position
+
+    def clear_tiles(self):
+        if self.tiled is not None:
+            self.tiled.cancel()
+            self.scene.removeItem(self.tiled)
+            self.tiled = None
+
+
+    @catch
+    def view_position(self):
+        return self.view.center()
 
 
     @catch
     def show_image(self):
-        self.rotate_view()
-        self.pixmap_view.setPixmap(self.image.pixmap)
+        start = time.perf_counter()
+
+        # before zoom_to_fit(), they change the view's size
+        self.layout_panes()
+        # ensure_resolution() shows them again if needed
+        self.clear_tiles()
+
+        with self.timings.span('rotate_view'):
+            self.rotate_view()
+        with self.timings.span('set_pixmap'):
+            self.set_pixmap()
 
         if self.zoom_level != 1.0:
-            self.zoom_to_fit()
+            with self.timings.span('zoom_to_fit'):
+                self.zoom_to_fit()
 
         # we might have rotated the view, but the scene still has the image
         # in its original size, so we use that as bounding rect
-        boundingRect = QRectF(self.pixmap_view.pixmap().rect())
+        boundingRect = self.pixmap_view.sceneBoundingRect()
         logger.debug(boundingRect)
         self.scene.setSceneRect(boundingRect)
 
@@ -569,117 +1281,123 @@ class Filter(QWidget):
             self.original_position = position
             self.view.centerOn(self.pixmap_view)
 
+        self.sync_panes()
+        self.ensure_resolution()
         self.update_view()
 
+        self.timings.add('show_image', time.perf_counter() - start)
 
-    @catch
-    def update_view(self):
-        self.fname.setText(self.image.path)
-        label = self.label_map[self.image.action]
-        self.tag_view.setText(label)
 
-        meta = self.image.metadata
-
-        date = read_image_date(self.image.path, meta)
-        if date is None:
-            self.date.setText('Unknown')
+    def layout_panes(self):
+        """In compare mode, show the next images of the compare set next to
+        the current one."""
+        if self.comparing and self.images.live_count() > 1:
+            count = min(self.panes_count, self.images.live_count()) - 1
+            images = self.images.neighbours(count, 1)
+        elif all(pane.image is None for pane in self.panes):
+            # nothing to do
+            return
         else:
-            self.date.setText(date.isoformat())
+            images = []
 
-        size = f"{meta.get_metadata_pixel_width()}px x {meta.get_metadata_pixel_height()}px"
-        self.size.setText(size)
+        for pane, image in zip_longest(self.panes, images):
+            if image is None or not self.read(image=image):
+                pane.clear()
+                pane.hide()
+            else:
+                pane.set_image(image)
+                pane.show()
 
-        # get_focal_length() returns a float, so int() first, then str()
-        self.focal_length.setText(f"{int(meta.get_focal_length())}mm")
+        # resize the views now
+        self.views_layout.activate()
 
-        # OTOH, Exif.Photo.FocalLengthIn35mmFilm returns a str() already
-        value = meta.get('Exif.Photo.FocalLengthIn35mmFilm', 'Unknown')
-        self.focal_length_35mm_equivalent.setText(f"{value}mm")
 
-        f = meta.get_exposure_time()
-        if f is None:
-            s = 'unknown'
-        elif f.denominator == 1:
-            s = f"{f.numerator}s"
-        else:
-            s = f"{f.numerator}/{f.denominator}s"
-        self.exposure_time.setText(s)
+    def sync_panes(self):
+        center = self.view_position()
 
-        self.aperture.setText(f"f/{meta.get_fnumber()}")
+        self.syncing = True
+        for pane in self.panes:
+            if pane.image is not None:
+                pane.sync(self.zoom_level, center)
+        self.syncing = False
 
-        self.iso_speed.setText(f"ISO {meta.get_iso_speed()}")
 
-        self.focus.setText(meta.get('Exif.Nikon3.Focus', 'N/A').strip())
+    @catch
+    def pan(self, view):
+        """In compare mode, when one of the views is panned, pan the others
+        to the same point."""
+        if not self.comparing or self.syncing or self.image is None:
+            return
 
-        try:
-            distance = int(meta['Exif.NikonLd3.FocusDistance'])
-        except KeyError:
-            self.focus_distance.setText('None')
-        else:
-            # see https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L4235
-            value_conv = 0.01 * 10 ** (distance / 40)
-            self.focus_distance.setText(f"{value_conv:.1f}m")
+        center = view.center()
 
-        try:
-            stops = Fraction(meta['Exif.Photo.ExposureBiasValue'])
-        except (KeyError, ZeroDivisionError):
-            self.exposure_compensation.setText('None')
-        else:
-            self.exposure_compensation.setText(f"{stops} stops")
+        self.syncing = True
+        for other in [ self.view ] + self.panes:
+            if other is not view and (other is self.view or other.image is not None):
+                other.centerOn(center)
+        self.syncing = False
 
-        value = meta.get('Exif.Nikon3.ActiveDLighting', '0')
-        self.active_dlightning.setText(self.active_dlightning_map[value])
 
-        # multi exposure
-        # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8118
-        # incoming/01-tmp/2020-11-06T22.58.14.jpg  Exif.NikonMe.MultiExposureMode               Long        1  (3)
-        # incoming/01-tmp/2020-11-06T22.58.14.jpg  Exif.NikonMe.MultiExposureShots              Long        1  2
-        value = meta.get('Exif.NikonMe.MultiExposureMode', '0')
-        self.multiple_exposure.setText(self.multiple_exposure_map[value])
+    @catch
+    def cycle_panes(self, *args):
+        """Show from 1 to 4 images side by side in compare mode."""
+        self.panes_count = self.panes_count % (len(self.panes) + 1) + 1
 
-        value = meta.get('Exif.NikonMe.MultiExposureShots', 'N/A')
-        self.multiple_exposure_shots.setText(value)
+        if self.comparing:
+            self.show_image()
 
-        # hdr
-        # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8144
-        # value = meta.get('', 'N/A')
-        # self.hdr.setText(value)
 
-        # exposure time
-        # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8266
-        # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8371
+    @catch
+    def set_pixmap(self):
+        place_pixmap(self.pixmap_view, self.image)
 
-        value = self.get_value(meta, [ 'Exif.Nikon3.WhiteBalance', 'Exif.CanonPr.WhiteBalance' ],'Unknown')
-        self.white_balance.setText(value)
-        # Exif.Nikon3.WhiteBalanceBias
 
-        value = meta.get('Exif.NikonPc.Name', 'Unknown').strip().title()
-        self.picture_control.setText(value)
+    @catch
+    def update_view(self):
+        start = time.perf_counter()
 
-        value = meta.get('Exif.Nikon3.NoiseReduction', 'Unknown').strip().title()
-        self.noise_reduction.setText(value)
+        self.fname.setText(self.image.path)
+        label = self.label_map[self.image.action]
+        self.tag_view.setText(label)
 
-        value = meta.get('Exif.Image.Make', 'Unknown').strip().title()
-        self.brand.setText(value)
+        with self.timings.span('metadata_cache'):
+            fields = self.metadata_cache.get(self.image.path)
+        if fields is None:
+            # GExiv2
+            with self.timings.span('panel_fields'):
+                fields = safe_panel_fields(self.image.path, self.image.metadata)
+            self.metadata_cache.put(self.image.path, fields)
 
-        value = meta.get('Exif.Image.Model', 'Unknown').strip().title()
-        self.model.setText(value)
+        for name, value in fields.items():
+            getattr(self, name).setText(value)
 
         self.update_rating()
 
+        self.timings.add('update_view', time.perf_counter() - start)
+
 
     @catch
     def update_rating(self, name=None):
         if name is None:
             name = os.path.basename(self.image.path)
 
-        image = digikam.image(name)
-        if image is not None:
-            self.rating.setText(str(image.info[0].rating))
+        rating = self.ratings.get(name)
+        if rating is not None:
+            self.rating.setText(str(rating))
         else:
             self.rating.setText('N/A')
 
 
+    @catch
+    def refresh_ratings(self):
+        # pick up the changes digiKam might have made
+        with self.timings.span('digikam'):
+            refreshed = self.ratings.refresh()
+
+        if refreshed and self.image is not None:
+            self.update_rating()
+
+
     @catch
     def save_position(self):
         position = self.view_position()
@@ -690,6 +1408,7 @@ class Filter(QWidget):
             logger.debug("saving position: %f x %f", position.x(), position.y())
             # this way (I hope) I only remember those positions which changed
             self.image_positions[self.image.path] = position
+            self.session.position(self.image.path, position)
 
 
     # movements
@@ -723,7 +1442,7 @@ class Filter(QWidget):
 
     @catch
     def last_image(self, *args):
-        self.move_index(to=len(self.images)-1)
+        self.move_index(to=self.images.live_index(-1))
 
 
     @catch
@@ -735,54 +1454,65 @@ class Filter(QWidget):
         else:
             # logger.info('orig')
             self.zoom(1.0)
+            self.ensure_resolution()
 
 
     @catch
+    @not_applying
     def rotate_left(self, *args):
         self.image.rotate(Image.left)
+        # so it's not taken for modified by someone else
+        self.modified(self.image.path)
         self.show_image()
 
 
     @catch
+    @not_applying
     def rotate_right(self, *args):
         self.image.rotate(Image.right)
+        self.modified(self.image.path)
         self.rotate_view()
+        self.ensure_resolution()
 
 
     # image actions
     # Keep -> /gallery/foo, resized
     @catch
+    @not_applying
     def keep(self, *args):
-        self.image.action = 'K'
+        self.set_action(self.image, 'K')
         self.tagged_count += 1
         self.next_image()
 
 
     # Tag -> /gallery/foo, as-is
     @catch
+    @not_applying
     def tag(self, *args):
-        self.image.action = 'T'
+        self.set_action(self.image, 'T')
         self.tagged_count += 1
         self.next_image()
 
 
     # Stitch -> 02-new/stitch
     @catch
+    @not_applying
     def stitch(self, *args):
-        self.image.action = 'S'
+        self.set_action(self.image, 'S')
         self.tagged_count += 1
         self.next_image()
 
 
     # coMpare
     @catch
+    @not_applying
     def select_for_compare(self, *args):
         if self.image.action == 'M':
             # TODO?: undo/toggle
             # NOTE: this can already be achieved by Untag
             pass
         else:
-            self.image.action = 'M'
+            self.set_action(self.image, 'M')
             # ugh
             self.compare_set.add(self.image)
             logger.debug(self.compare_set.images)
@@ -790,26 +1520,75 @@ class Filter(QWidget):
         self.next_image()
 
 
+    @catch
+    @not_applying
+    def compare_burst(self, *args):
+        """Put the burst the current image is in in the compare set and
+        compare them. Images already tagged otherwise are left out."""
+        if self.comparing:
+            return
+
+        # the images are sorted by name, so a burst's are together
+        candidates = ( self.images.neighbours(self.burst_size, -1)[::-1] + [ self.image ] +
+                       self.images.neighbours(self.burst_size, 1) )
+        candidates = [ image for image in candidates
+                       if image is self.image or (image.action in (None, 'M') and not image.applying) ]
+        by_path = { image.path: image for image in candidates }
+
+        with self.timings.span('burst'):
+            burst = self.hash_index.group(list(by_path), self.image.path)
+        logger.info("%d images in %s's burst", len(burst), self.image.path)
+
+        for path in burst:
+            image = by_path[path]
+            if image.action != 'M':
+                self.set_action(image, 'M')
+            if image.path not in self.compare_set.paths:
+                self.compare_set.add(image)
+
+        self.compare()
+
+
     @catch
     def compare(self, *args):
         logger.info('comparing')
         self.comparing = True
+        self.session.comparing(True)
         self.images = self.compare_set
+        self.decode_compare_set()
         self.move_index(to=0)
 
 
+    def decode_compare_set(self):
+        """Decode all the images to compare now, and keep them decoded while
+        comparing, so moving between them costs nothing."""
+        # the views get narrower
+        self.layout_panes()
+        self.prefetcher.size = self.view.size() * self.view.devicePixelRatioF()
+
+        images = [ image for image in self.compare_set if image.pixmap is None ]
+        for image in images:
+            self.prefetcher.request(image.path)
+
+        for image in images:
+            if not self.read(image=image):
+                image.ignored = True
+
+
     # Crop -> launch gwenview
     @catch
+    @not_applying
     def crop(self, *args):
-        self.image.action = 'C'
+        self.set_action(self.image, 'C')
         self.tagged_count += 1
         self.next_image()
 
 
     # Delete -> /dev/null
     @catch
+    @not_applying
     def delete(self, *args):
-        self.image.action = 'D'
+        self.set_action(self.image, 'D')
         self.tagged_count += 1
         logger.info("[%d] %s marked for deletion", self.images.index, self.image.path)
 
@@ -822,10 +1601,16 @@ class Filter(QWidget):
             self.next_image()
 
 
+    def set_action(self, image, action):
+        image.action = action
+        self.session.action(image.path, action)
+
+
     @catch
+    @not_applying
     def untag(self, *args):
         try:
-            self.image.action = None
+            self.set_action(self.image, None)
             # don't move, most probably I'm reconsidering what to do
             # but change the label
             self.tag_view.setText('')
@@ -835,132 +1620,113 @@ class Filter(QWidget):
             pass
 
 
-    @catch
-    def resize(self, src, dst):
-        src_meta = GExiv2.Metadata(src)
-        src_p = QPixmap(src)
-        dst_p = src_p.scaled(4500, 3000, Qt.KeepAspectRatio,
-                             Qt.SmoothTransformation)
-
-        dst_p.save(src)
-        shutil.move(src, dst)
-
-        # copy all the metadata
-        dst_meta = GExiv2.Metadata(dst)
-        for tag in src_meta.get_tags():
-            dst_meta[tag] = src_meta[tag]
-
-        dst_meta.save_file()
-
-
     @catch
     def apply(self, *args):
         if not self.comparing:
-            done_count = 0
-            self.pbar.setRange(1, self.tagged_count)
-
-            hugin = False
-
-            if len([ img.action for img in self.images if img.action in ('K', 'T') ]) > 0:
-                self.new_dst()
-
-            for index, img in enumerate(self.images):  # already sorted by fname
-                if img.ignored:
-                    continue
-
-                src = img.path
-                dst = os.path.join(self.dst, os.path.basename(src))
-                action = img.action
-
-                if action is not None:
-                    logger.debug((src, dst, action))
-
-                try:
-                    if src in self.new_files and action not in ('C', 'D'):
-                        # rename
-                        src = rename_file(src)
-
-                    if   action == 'K':
-                        # Keep -> /gallery/foo, as-is
-                        logger.info("%s -> %s", src, dst)
-                        shutil.move(src, dst)
-
-                        done_count += 1
-                        self.pbar.setValue(done_count)
-
-                    elif action == 'T':
-                        # Take -> /gallery/foo, resized
-                        self.resize(src, dst)
-
-                        done_count += 1
-                        self.pbar.setValue(done_count)
-
-                    elif action == 'S':
-                        # Stitch -> 02-new/stitch
-                        dst = os.path.join('/home/mdione/Pictures/incoming/02-new/stitch',
-                                           os.path.basename(src))
-                        logger.info("%s -> %s", src, dst)
-                        shutil.move(src, dst)
-                        hugin = True
-
-                    elif action == 'M':
-                        # coMpare -> 03-cur
-                        dst = os.path.join('/home/mdione/Pictures/incoming/03-cur',
-                                           os.path.basename(src))
-                        logger.info("%s -> %s", src, dst)
-                        shutil.move (src, dst)
-
-                        new_root = '/home/mdione/Pictures/incoming/03-cur'
-                        old_root = self.src
-
-                    elif action == 'C':
-                        # Crop -> launch gwenview
-                        os.system('gwenview %s' % src)
-
-                        # asume the file was saved under a new name
-                        # logger.info("%s -> %s", src, dst)
-                        # shutil.move(src, dst)
+            if self.batch is not None:
+                logger.warning("still applying the previous batch")
+                return
 
-                        done_count += 1
-                        self.pbar.setValue(done_count)
+            # files are about to be moved, so make sure digiKam has the ratings
+            self.rating_writer.flush()
 
-                    elif action == 'D':
-                        # Delete -> /dev/null
-                        os.unlink(src)
-                        logger.info("%s deleted", src)
+            # the files are processed in the background, so we can keep
+            # working on the rest; new files are renamed even if not tagged
+            jobs = [ (img, img.action) for img in self.images  # already sorted by fname
+                     if not img.ignored and (img.action is not None or
+                                             (img.path in self.new_files and
+                                              img.path not in self.renamed)) ]
 
-                        done_count += 1
-                        self.pbar.setValue(done_count)
-
-                    if action in ('K', 'T', 'D', 'C', 'S'):
-                        # don't show the image anymore
-                        logger.debug("%s ignored", img)
-                        img.ignored = True
-
-                except FileNotFoundError as e:
-                    logger.info(e)
+            if len([ action for img, action in jobs if action in ('K', 'T') ]) > 0:
+                self.new_dst()
 
-            if hugin:
-                os.system('hugin')
+            for img, action in jobs:
+                img.applying = True
 
-            self.tagged_count = 0
+            self.pbar.setRange(0, len(jobs))
+            self.pbar.setValue(0)
 
-            self.reset()
+            self.batch = Batch(jobs, self.dst, self.new_files, self.resize_workers,
+                               stitch_dir=self.stitch_dir, compare_dir=self.compare_dir,
+                               hugin=self.hugin, renamed=self.renamed, timings=self.timings,
+                               parent=self)
+            self.batch.processed.connect(self.batch_processed)
+            self.batch.finished.connect(self.batch_finished)
+            self.batch.start()
         else:
             logger.info('back to all')
             self.comparing = False
+            self.session.comparing(False)
 
             # untag all images marked for compare
             for image in self.compare_set:
                 # but only those still marked 'M'
                 if image.action == 'M':
-                    image.action = None
+                    self.set_action(image, None)
+
+                if image is not self.image:
+                    image.release()
 
             self.compare_set.clear()
             self.images = self.all_images
             self.move_index()
 
 
+    @catch
+    def batch_processed(self, img, ignore):
+        img.applying = False
+        if ignore:
+            logger.debug("%s ignored", img)
+            img.ignored = True
+            self.session.ignored(img.path)
+
+        self.pbar.setValue(self.pbar.value() + 1)
+
+
+    @catch
+    def batch_finished(self):
+        # those not processed because it was cancelled
+        for img, action in self.batch.jobs:
+            img.applying = False
+
+        # the new files that were just renamed are there with their new name
+        renamed = { img: self.renamed.pop(img.path) for img, action in self.batch.jobs
+                    if action is None and img.path in self.renamed }
+        if len(renamed) > 0:
+            current = renamed.get(self.image)
+
+            for img in renamed:
+                img.ignored = True
+                self.forget(img)
+
+            paths = list(renamed.values())
+            self.all_images.add_many(sorted(Image(path) for path in paths))
+            self.metadata_cache.fill(paths)
+            self.hash_index.fill(paths)
+            self.ratings.add(os.path.basename(path) for path in paths)
+
+            if current is not None:
+                self.move_index(to=self.images.find(current))
+
+        self.batch = None
+        self.tagged_count = len([ img for img in self.all_images
+                                  if img.action is not None and not img.ignored ])
+
+        if len(self.changed_dirs) > 0:
+            dirs = sorted(self.changed_dirs)
+            self.changed_dirs.clear()
+            self.directories_changed(dirs)
+
+        # not reset(): we might have started comparing while it was applied
+        self.pbar.reset()
+
+
+    @catch
+    def cancel_apply(self, *args):
+        if self.batch is not None:
+            self.batch.cancel()
+
+
     @catch
     def expunge(self, *args):
         for img in self.images:
@@ -971,11 +1737,12 @@ class Filter(QWidget):
                     os.unlink(src)
                     self.images.remove(img)
                     img.ignored = True
+                    self.session.ignored(src)
                     logger.info("%s deleted", src)
 
                     # we don't really remove images, just mark them as so
                     # so remove the action
-                    img.action = None
+                    self.set_action(img, None)
             except FileNotFoundError as e:
                 logger.info(e)
 
@@ -988,6 +1755,7 @@ class Filter(QWidget):
         self.image_actions.clear()
         self.compare_set.clear()
         self.comparing = False
+        self.session.comparing(False)
 
         self.pbar.reset()
 
@@ -1008,20 +1776,24 @@ class Filter(QWidget):
 
 
     @catch
+    @not_applying
     def save(self, *args):
         src = self.image.path
         self.dir_dialog.setDirectory(self.dst)
         if self.dir_dialog.exec():
             dst_dir = self.dir_dialog.selectedFiles()[0]
+            src = self.renamed.get(src, src)
             if src in self.new_files:
                 src = rename_file(src)
+                self.renamed[self.image.path] = src
 
             dst = os.path.join(dst_dir, os.path.basename(src))
 
             logger.info("%s -> %s", src, dst)
-            self.resize(src, dst)
+            resize(src, dst)
 
             self.image.ignored = True
+            self.session.ignored(self.image.path)
             self.next_image()
 
 
@@ -1029,19 +1801,34 @@ if __name__ == '__main__':
     config =  ConfigParser()
     config.read('ananke.ini')
 
+    # before any of the threads that read the metadata start
+    GExiv2.initialize()
+
     app = QApplication(sys.argv)
 
     # import
     src = config['Directories']['src']
     mid = config['Directories']['mid']
-    new = workflow.import_files(src, mid)
+    manifest = workflow.ImportManifest(config.get('Import', 'manifest',
+                                                  fallback=os.path.expanduser('~/.cache/ananke/import.db')))
+    new = workflow.import_files(src, mid,
+                                workers=config.getint('Import', 'workers', fallback=4),
+                                verify=config.getboolean('Import', 'verify', fallback=False),
+                                manifest=manifest)
 
     win = QMainWindow()
 
     view = Filter(win, config, new)
-    show_first_image = QTimer.singleShot(200, view.first_image)
 
     win.setCentralWidget(view)
     win.showFullScreen()
 
+    app.aboutToQuit.connect(view.prefetcher.shutdown)
+    app.aboutToQuit.connect(view.metadata_cache.shutdown)
+    app.aboutToQuit.connect(view.hash_index.shutdown)
+    app.aboutToQuit.connect(lambda: view.tile_executor.shutdown(wait=False, cancel_futures=True))
+    app.aboutToQuit.connect(view.rating_writer.stop)
+    app.aboutToQuit.connect(view.close_session)
+    app.aboutToQuit.connect(lambda: print(f"image cache: {view.cache.stats()}"))
+
     app.exec_()
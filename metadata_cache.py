@@ -0,0 +1,285 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from fractions import Fraction
+from threading import Lock, Thread
+
+import gi
+gi.require_version('GExiv2', '0.10')
+from gi.repository import GExiv2, GLib
+
+from rename_pictures import read_image_date
+
+import logging
+logger = logging.getLogger("metadata")
+
+# see https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8128
+multiple_exposure_map = {
+    '0': 'Off',
+    # '1': 'Multiple Exposure',
+    '1': 'Manual',
+    '2': 'Image Overlay',
+    '3': 'HDR',
+}
+
+active_dlightning_map = {
+        '0': 'Off',
+    '65535': 'Auto',
+        '7': 'Extra High',
+        '5': 'High',
+        '3': 'Normal',
+        '1': 'Low',
+}
+
+
+# the labels panel_fields() fills
+FIELDS = ('date', 'size', 'focal_length', 'focal_length_35mm_equivalent', 'exposure_time',
+          'aperture', 'iso_speed', 'focus', 'focus_distance', 'exposure_compensation',
+          'active_dlightning', 'multiple_exposure', 'multiple_exposure_shots', 'white_balance',
+          'picture_control', 'noise_reduction', 'brand', 'model')
+
+
+def get_value(meta, tags, default):
+    """Return the value of the first of tags found in meta."""
+    for tag in tags:
+        try:
+            return meta[tag]
+        except KeyError:
+            pass
+
+    return default
+
+
+def panel_fields(path, meta):
+    """Format the metadata shown in Filter's left panel. Returns a dict with
+    the texts for each label."""
+    fields = {}
+
+    date = read_image_date(path, meta)
+    if date is None:
+        fields['date'] = 'Unknown'
+    else:
+        fields['date'] = date.isoformat()
+
+    fields['size'] = f"{meta.get_metadata_pixel_width()}px x {meta.get_metadata_pixel_height()}px"
+
+    # get_focal_length() returns a float, so int() first, then str()
+    fields['focal_length'] = f"{int(meta.get_focal_length())}mm"
+
+    # OTOH, Exif.Photo.FocalLengthIn35mmFilm returns a str() already
+    value = meta.get('Exif.Photo.FocalLengthIn35mmFilm', 'Unknown')
+    fields['focal_length_35mm_equivalent'] = f"{value}mm"
+
+    f = meta.get_exposure_time()
+    if f is None:
+        s = 'unknown'
+    elif f.denominator == 1:
+        s = f"{f.numerator}s"
+    else:
+        s = f"{f.numerator}/{f.denominator}s"
+    fields['exposure_time'] = s
+
+    fields['aperture'] = f"f/{meta.get_fnumber()}"
+
+    fields['iso_speed'] = f"ISO {meta.get_iso_speed()}"
+
+    fields['focus'] = meta.get('Exif.Nikon3.Focus', 'N/A').strip()
+
+    try:
+        distance = int(meta['Exif.NikonLd3.FocusDistance'])
+    except KeyError:
+        fields['focus_distance'] = 'None'
+    else:
+        # see https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L4235
+        value_conv = 0.01 * 10 ** (distance / 40)
+        fields['focus_distance'] = f"{value_conv:.1f}m"
+
+    try:
+        stops = Fraction(meta['Exif.Photo.ExposureBiasValue'])
+    except (KeyError, ZeroDivisionError):
+        fields['exposure_compensation'] = 'None'
+    else:
+        fields['exposure_compensation'] = f"{stops} stops"
+
+    value = meta.get('Exif.Nikon3.ActiveDLighting', '0')
+    fields['active_dlightning'] = active_dlightning_map[value]
+
+    # multi exposure
+    # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8118
+    # incoming/01-tmp/2020-11-06T22.58.14.jpg  Exif.NikonMe.MultiExposureMode               Long        1  (3)
+    # incoming/01-tmp/2020-11-06T22.58.14.jpg  Exif.NikonMe.MultiExposureShots              Long        1  2
+    value = meta.get('Exif.NikonMe.MultiExposureMode', '0')
+    fields['multiple_exposure'] = multiple_exposure_map[value]
+
+    fields['multiple_exposure_shots'] = meta.get('Exif.NikonMe.MultiExposureShots', 'N/A')
+
+    # hdr
+    # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8144
+    # value = meta.get('', 'N/A')
+    # fields['hdr'] = value
+
+    # exposure time
+    # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8266
+    # https://github.com/exiftool/exiftool/blob/master/lib/Image/ExifTool/Nikon.pm#L8371
+
+    fields['white_balance'] = get_value(meta, [ 'Exif.Nikon3.WhiteBalance', 'Exif.CanonPr.WhiteBalance' ],'Unknown')
+    # Exif.Nikon3.WhiteBalanceBias
+
+    fields['picture_control'] = meta.get('Exif.NikonPc.Name', 'Unknown').strip().title()
+    fields['noise_reduction'] = meta.get('Exif.Nikon3.NoiseReduction', 'Unknown').strip().title()
+    fields['brand'] = meta.get('Exif.Image.Make', 'Unknown').strip().title()
+    fields['model'] = meta.get('Exif.Image.Model', 'Unknown').strip().title()
+
+    return fields
+
+
+def safe_panel_fields(path, meta):
+    """panel_fields(), or N/A for all of them if the metadata has values it
+    doesn't know about."""
+    try:
+        return panel_fields(path, meta)
+    except (KeyError, ValueError, TypeError, ZeroDivisionError) as e:
+        logger.info("can't show %s's metadata: %r", path, e)
+        return { name: 'N/A' for name in FIELDS }
+
+
+def file_key(path):
+    """The cached fields are valid while the file's size and mtime don't change."""
+    s = os.stat(path)
+
+    return s.st_size, s.st_mtime_ns
+
+
+def read_fields(path):
+    """Runs in the workers."""
+    try:
+        key = file_key(path)
+        meta = GExiv2.Metadata(path)
+        fields = safe_panel_fields(path, meta)
+    except (OSError, GLib.Error) as e:
+        logger.info("Error loading %s's metadata: %s", path, e)
+        return None
+
+    return path, key, fields
+
+
+class MetadataCache:
+    """A SQLite backed cache of panel_fields() per file, keyed by path, size
+    and mtime, so the panel can be rendered without parsing the metadata.
+
+    fill() populates it in the background."""
+
+
+    def __init__(self, db_path, workers=2):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # the filler thread writes too
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS fields (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER NOT NULL,
+                               mtime INTEGER NOT NULL,
+                               fields TEXT NOT NULL
+                           )''')
+        self.db.commit()
+        self.lock = Lock()
+
+        self.workers = workers
+        # one per fill() running
+        self.executors = set()
+
+
+    def get(self, path):
+        """Return the cached fields for path, or None if not cached or stale."""
+        try:
+            key = file_key(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, fields FROM fields WHERE path = ?',
+                                  (path, )).fetchone()
+
+        if row is None or tuple(row[:2]) != key:
+            return None
+
+        return json.loads(row[2])
+
+
+    def put(self, path, fields):
+        try:
+            key = file_key(path)
+        except OSError:
+            return
+
+        self.put_many([ (path, key, fields) ])
+
+
+    def put_many(self, rows):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?)',
+                                [ (path, size, mtime, json.dumps(fields))
+                                  for path, (size, mtime), fields in rows ])
+            self.db.commit()
+
+
+    def fill(self, paths, batch_size=100):
+        """Read the metadata of those paths not cached yet in worker threads."""
+        thread = Thread(target=self.fill_thread, args=(list(paths), batch_size),
+                        name='metadata-fill', daemon=True)
+        thread.start()
+
+
+    def fill_thread(self, paths, batch_size):
+        with self.lock:
+            cached = { path: (size, mtime)
+                       for path, size, mtime in self.db.execute('SELECT path, size, mtime FROM fields') }
+
+        missing = []
+        for path in paths:
+            try:
+                if cached.get(path) != file_key(path):
+                    missing.append(path)
+            except OSError:
+                pass
+
+        logger.debug("%d/%d to fill", len(missing), len(paths))
+        if len(missing) == 0:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.workers,
+                                      thread_name_prefix='metadata')
+        with self.lock:
+            self.executors.add(executor)
+
+        rows = []
+        try:
+            for row in executor.map(read_fields, missing):
+                if row is not None:
+                    rows.append(row)
+
+                if len(rows) == batch_size:
+                    self.put_many(rows)
+                    rows = []
+        except (CancelledError, RuntimeError):
+            # shutdown(); save what we have
+            pass
+        finally:
+            if len(rows) > 0:
+                self.put_many(rows)
+
+            with self.lock:
+                self.executors.discard(executor)
+
+            executor.shutdown()
+
+
+    def shutdown(self):
+        with self.lock:
+            executors = list(self.executors)
+
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+# just enough of the ISO base media file format (MP4, MOV, 3GP) to read the
+# creation time without forking ffprobe
+
+import struct
+from datetime import datetime, timedelta
+
+# the times in mvhd are seconds since this, in UTC
+EPOCH = datetime(1904, 1, 1)
+
+# atoms that can only appear at the top level; if the file doesn't start
+# with one, it's not for us
+top_level = (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot')
+
+
+def is_mp4(f):
+    f.seek(4)
+    return f.read(4) in top_level
+
+
+def atoms(f, start, end):
+    """Yield (type, data_start, data_end) for the atoms in f between start
+    and end, seeking over their data."""
+    position = start
+
+    while position + 8 <= end:
+        f.seek(position)
+        size, type = struct.unpack('>I4s', f.read(8))
+        header = 8
+
+        if size == 1:
+            # 64 bit size
+            size, = struct.unpack('>Q', f.read(8))
+            header = 16
+        elif size == 0:
+            # up to the end
+            size = end - position
+
+        if size < header:
+            raise ValueError(f"bad atom size {size} at {position}")
+
+        yield type, position + header, min(position + size, end)
+
+        position += size
+
+
+def find(f, start, end, type):
+    """Return (data_start, data_end) for the first atom of that type, or None."""
+    for atom_type, data_start, data_end in atoms(f, start, end):
+        if atom_type == type:
+            return data_start, data_end
+
+    return None
+
+
+def read_mvhd(f, start):
+    f.seek(start)
+    version, = struct.unpack('>B3x', f.read(4))
+
+    if version == 1:
+        creation_time, = struct.unpack('>Q', f.read(8))
+    else:
+        creation_time, = struct.unpack('>I', f.read(4))
+
+    if creation_time == 0:
+        return None
+
+    return EPOCH + timedelta(seconds=creation_time)
+
+
+def read_day(f, start, end):
+    """©day in udta, like '2016-07-17T16:46:04+0200'. Returns the local time."""
+    # 16 bit length, 16 bit language
+    f.seek(start)
+    length, = struct.unpack('>H', f.read(2))
+    f.seek(2, 1)
+    value = f.read(min(length, end - start - 4)).decode('utf-8', 'replace')
+
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value[:19], format)
+        except ValueError:
+            pass
+
+    return None
+
+
+def read_creation_time(path):
+    """Return the creation time of the movie in path as a naive datetime, or
+    None if it doesn't say. Raises ValueError if it's not a file we can parse.
+
+    Like ffprobe's creation_time, this is in UTC, as mvhd's; only if that's
+    missing we use udta's ©day."""
+    with open(path, 'rb') as f:
+        if not is_mp4(f):
+            raise ValueError('not an MP4/MOV file')
+
+        end = f.seek(0, 2)
+
+        moov = find(f, 0, end, b'moov')
+        if moov is None:
+            raise ValueError('no moov atom')
+
+        mvhd = find(f, *moov, b'mvhd')
+        if mvhd is not None:
+            date = read_mvhd(f, mvhd[0])
+            if date is not None:
+                return date
+
+        udta = find(f, *moov, b'udta')
+        if udta is not None:
+            day = find(f, *udta, b'\xa9day')
+            if day is not None:
+                return read_day(f, *day)
+
+    return None
@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+from timing import Timings
+
+import gi
+gi.require_version('GExiv2', '0.10')
+from gi.repository import GExiv2, GLib
+
+import logging
+logger = logging.getLogger("prefetch")
+
+
+# these orientations swap width and height
+transposed = ('5', '6', '7', '8')
+
+
+def tier(full):
+    return 'full' if full else 'screen'
+
+
+def decode(path, size=None):
+    """Decode the image and open its metadata. Returns the QImage, the size of
+    the full image and the metadata.
+
+    If size is given, the image is decoded just big enough to fit it once
+    rotated; for JPEGs this is done while decoding (DCT scaling), which is
+    much faster than decoding it full and scaling it down.
+
+    Only uses QImage, which unlike QPixmap can be used outside the UI thread,
+    so this can run in the workers."""
+    try:
+        metadata = GExiv2.Metadata(path)
+    except GLib.Error as e:
+        logger.info("Error loading %s's metadata: %s", path, e)
+        metadata = None
+
+    reader = QImageReader(path)
+    # this only reads the header
+    full_size = reader.size()
+
+    if not full_size.isValid():
+        # the format can't tell without decoding, so it will be decoded full
+        size = None
+    elif size is not None:
+        if metadata is not None and metadata.get('Exif.Image.Orientation', '1') in transposed:
+            size = size.transposed()
+
+        scaled_size = full_size.scaled(size, Qt.KeepAspectRatio)
+        if scaled_size.width() < full_size.width():
+            reader.setScaledSize(scaled_size)
+
+    qimage = reader.read()
+    if size is None:
+        full_size = qimage.size()
+
+    return qimage, full_size, metadata
+
+
+def preview(metadata):
+    """Return the biggest preview embedded in the metadata as a QImage, or None.
+
+    Camera JPEGs and raw files usually carry one of 1-2MP that we can show
+    without decoding the main image."""
+    previews = metadata.get_preview_properties()
+    if not previews:
+        return None
+
+    properties = max(previews, key=lambda p: p.get_width() * p.get_height())
+    data = metadata.get_preview_image(properties).get_data()
+
+    qimage = QImage()
+    if not qimage.loadFromData(data):
+        return None
+
+    return qimage
+
+
+class Prefetcher(QObject):
+    """Decodes the images around the cursor of an ImageList in worker threads.
+
+    The window is made of the current image, the next `ahead` images in the
+    direction we're moving and the previous `behind` ones, skipping ignored
+    images. Decodes for images that fall out of the window and haven't
+    started yet are cancelled.
+
+    These are decoded to fit `size` (see decode()); full resolution decodes
+    are only done on request. Either way the results go to the cache.
+
+    The decodes are timed as the 'decode' stage in timings."""
+
+    # emitted from the workers, so it reaches the UI thread queued
+    # path, full
+    decoded = pyqtSignal(str, bool)
+
+
+    def __init__(self, cache, ahead=4, behind=1, workers=2, timings=None, parent=None):
+        QObject.__init__(self, parent)
+        self.cache = cache
+        self.timings = timings if timings is not None else Timings()
+        self.ahead = ahead
+        self.behind = behind
+        self.direction = 1
+        # the size of the view; None means decode at full resolution
+        self.size = None
+
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='prefetch')
+        # (path, full) -> Future; the result is decode()'s
+        self.pending = {}
+
+
+    def window(self, images, neighbours=True):
+        window = [ images.current_image ]
+        if neighbours:
+            window += images.neighbours(self.ahead, self.direction)
+            window += images.neighbours(self.behind, -self.direction)
+
+        # there might be less images than the window's size
+        paths = []
+        for image in window:
+            if image is not None and image.path not in paths:
+                paths.append(image.path)
+
+        return paths
+
+
+    def update(self, images, direction=0, neighbours=True):
+        """Move the window to the current position in images.
+
+        With neighbours=False only the current image is decoded."""
+        if direction != 0:
+            self.direction = direction
+
+        window = self.window(images, neighbours)
+
+        for key, future in list(self.pending.items()):
+            path, full = key
+            # the current image's full resolution one is kept
+            if future.done() or path not in window or (full and path != window[0]):
+                del self.pending[key]
+                # this only cancels those not started yet;
+                # we can't interrupt a running decode, it will still be cached
+                if future.cancel():
+                    logger.debug("cancelled %s", key)
+
+        # the window is sorted by priority, and the executor is FIFO
+        for path in window:
+            self.request(path)
+
+
+    def request(self, path, full=False):
+        """Start decoding path in the background, if it's not already."""
+        key = (path, full)
+
+        if key not in self.pending and (tier(full), path) not in self.cache:
+            logger.debug("prefetching %s", key)
+            future = self.executor.submit(self.decode, path, full)
+            future.add_done_callback(lambda future: self.done(key, future))
+            self.pending[key] = future
+
+
+    def decode(self, path, full):
+        with self.timings.span('decode'):
+            result = decode(path, None if full else self.size)
+        self.cache.put(tier(full), path, result)
+
+        return result
+
+
+    def done(self, key, future):
+        if not future.cancelled():
+            self.decoded.emit(*key)
+
+
+    def ready(self, path, full=False):
+        """Whether get() can return path's image without waiting."""
+        return (tier(full), path) in self.cache
+
+
+    def get(self, path, full=False):
+        """Return decode()'s result for path.
+
+        If it's not cached but a worker is already decoding it, wait for it;
+        if it was never requested, decode it here."""
+        result = self.cache.get(tier(full), path)
+
+        if result is None:
+            future = self.pending.get((path, full))
+
+            if future is None or future.cancelled():
+                logger.debug("decoding %s", path)
+                result = self.decode(path, full)
+            else:
+                logger.debug("waiting for %s", path)
+                result = future.result()
+
+        return result
+
+
+    def forget(self, path):
+        """Drop what we have for path, because it changed or disappeared.
+        A decode already running will still be cached."""
+        for full in (False, True):
+            future = self.pending.pop((path, full), None)
+            if future is not None:
+                future.cancel()
+
+        self.cache.remove(path)
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
@@ -7,12 +7,19 @@ from datetime import datetime
 import errno
 import subprocess
 import stat
+import struct
 import argparse
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import logging
 
 from gi.repository import GExiv2, GLib
 
+import exif
+import mp4
+
 log_format= "%(asctime)s %(name)16s:%(lineno)-4d (%(funcName)-21s) %(levelname)-8s %(message)s"
 logging.basicConfig (level=logging.INFO, format=log_format)
 logger= logging.getLogger ("rename")
@@ -21,18 +28,28 @@ logger= logging.getLogger ("rename")
 def read_image_date (file_name, metadata=None):
     if metadata is None:
         try:
-            metadata = GExiv2.Metadata (file_name)
-        except GLib.Error:
-            return None
+            # much faster than GExiv2, which parses everything
+            date = exif.read_date(file_name)
+        except (OSError, ValueError, struct.error):
+            # something unusual, let GExiv2 handle it
+            try:
+                metadata = GExiv2.Metadata (file_name)
+            except GLib.Error:
+                return None
+        else:
+            if date is None:
+                logger.warning ("could not read EXIF date for %s" % file_name)
+                return None
 
-    try:
-        date= metadata['Exif.Photo.DateTimeOriginal']
-    except KeyError:
+    if metadata is not None:
         try:
-            date= metadata['Exif.Image.DateTime']
+            date= metadata['Exif.Photo.DateTimeOriginal']
         except KeyError:
-            logger.warning ("could not read EXIF date for %s" % file_name)
-            return None
+            try:
+                date= metadata['Exif.Image.DateTime']
+            except KeyError:
+                logger.warning ("could not read EXIF date for %s" % file_name)
+                return None
 
     # '2016:07:17 16:46:04'
     try:
@@ -42,7 +59,45 @@ def read_image_date (file_name, metadata=None):
         return None
 
 
+# magic numbers of image files, which ffprobe has nothing to add about
+image_magics = (b'\xff\xd8', b'\x89PNG', b'II*\x00', b'MM\x00*')
+
+# (path, size, mtime) -> datetime or None
+video_dates = {}
+
+
 def read_video_date (file_name):
+    try:
+        s = os.stat(file_name)
+    except OSError:
+        return None
+
+    key = (file_name, s.st_size, s.st_mtime_ns)
+    try:
+        return video_dates[key]
+    except KeyError:
+        pass
+
+    try:
+        date = mp4.read_creation_time(file_name)
+    except (ValueError, struct.error):
+        # not an MP4/MOV, or one we can't parse
+        with open(file_name, 'rb') as f:
+            magic = f.read(4)
+
+        if magic.startswith(image_magics):
+            date = None
+        else:
+            date = read_video_date_ffprobe(file_name)
+    except OSError:
+        date = None
+
+    video_dates[key] = date
+
+    return date
+
+
+def read_video_date_ffprobe (file_name):
     cmd= 'ffprobe -show_format -loglevel quiet'.split ()
     cmd.append (file_name)
     output= subprocess.Popen (cmd, stdout=subprocess.PIPE,
@@ -66,6 +121,14 @@ def read_video_date (file_name):
     return date
 
 
+# variant (!!!; see https://xkcd.com/927/) of ISO 8601 compatible with Windows
+# .%f ignored because it's always 0
+# TODO: put in config file
+file_name_format = "%Y-%m-%dT%H.%M.%S"
+# TODO: put paths in config file
+by_date_format = "ByDate/%Y/%m"
+
+
 def build_filename (root, base_name, count, ext):
     if count is not None:
         base_name= "%s_%02d" % (base_name, count)
@@ -100,7 +163,7 @@ def is_free (src, dst):
     return free
 
 
-def rename_file(src, dry_run=False):
+def read_date(src):
     date = read_image_date(src)
 
     if date is None:
@@ -111,6 +174,12 @@ def rename_file(src, dry_run=False):
         print("%s: bad date field format (%r)" % (src, date))
         date = None
 
+    return date
+
+
+def rename_file(src, dry_run=False):
+    date = read_date(src)
+
     if date is not None:
         # we do two things here
         src_dir, src_name = os.path.split(src)
@@ -120,18 +189,12 @@ def rename_file(src, dry_run=False):
         # like src/2016-04-30T12.59.40.jpg
         # notice src_dir is equal to dst_dir
 
-        # variant (!!!; see https://xkcd.com/927/) of ISO 8601 compatible with Windows
-        # .%f ignored because it's always 0
-        # TODO: put in config file
-        file_name_format = "%Y-%m-%dT%H.%M.%S"
-
         dst_dir = src_dir
         # does not include extension
         dst_base_name = date.strftime (file_name_format)
 
         # then we also link it in the by_date dir
-        # TODO: put paths in config file
-        dst_by_date_dir = date.strftime("ByDate/%Y/%m")
+        dst_by_date_dir = date.strftime(by_date_format)
 
         # dst_dir is also src_dir, so we know it already exists :)
         os.makedirs(dst_by_date_dir, exist_ok=True)
@@ -178,13 +241,201 @@ def rename_file(src, dry_run=False):
         print("can't find file's date, skipping...")
 
 
+class RenamePlanner:
+    """Plans the renames and links done by rename_file() for many files at
+    once, without touching the disk.
+
+    Each directory involved is listed once, and the names planned so far are
+    kept in an index, so finding a free name doesn't need to stat() every
+    candidate. The files have to be planned in order, so the _NN suffixes
+    of same second shots are always the same."""
+
+
+    def __init__(self):
+        # dir -> { name: inode }
+        self.dirs = {}
+
+
+    def names(self, dir):
+        names = self.dirs.get(dir)
+
+        if names is None:
+            names = {}
+
+            try:
+                with os.scandir(dir or '.') as entries:
+                    for entry in entries:
+                        names[entry.name] = entry.inode()
+            except FileNotFoundError:
+                pass
+
+            self.dirs[dir] = names
+
+        return names
+
+
+    def is_free(self, path, inode):
+        """Like is_free(): the name is not taken, or by the same file."""
+        dir, name = os.path.split(path)
+        taken_by = self.names(dir).get(name)
+
+        return taken_by is None or taken_by == inode
+
+
+    def plan(self, src, date):
+        """Return (src, dst, dst_by_date, collided) for src. dst_by_date is
+        None if it's already linked there. collided is whether it needed a
+        suffix it didn't have already."""
+        src_dir, src_name = os.path.split(src)
+        ext = os.path.splitext(src_name)[1].lower()
+
+        inode = self.names(src_dir).get(src_name)
+        if inode is None:
+            inode = os.stat(src).st_ino
+
+        dst_base_name = date.strftime(file_name_format)
+        dst_by_date_dir = date.strftime(by_date_format)
+
+        count = None
+        while True:
+            dst = build_filename(src_dir, dst_base_name, count, ext)
+            dst_by_date = build_filename(dst_by_date_dir, dst_base_name, count, ext)
+
+            if self.is_free(dst, inode) and self.is_free(dst_by_date, inode):
+                break
+
+            if count is None:
+                count = 1
+            else:
+                count += 1
+
+        by_date_names = self.names(dst_by_date_dir)
+        if by_date_names.get(os.path.basename(dst_by_date)) == inode:
+            # already linked
+            dst_by_date = None
+
+        # update the index as if it was done
+        del self.names(src_dir)[src_name]
+        self.names(src_dir)[os.path.basename(dst)] = inode
+        if dst_by_date is not None:
+            by_date_names[os.path.basename(dst_by_date)] = inode
+
+        return src, dst, dst_by_date, count is not None and dst != src
+
+
+def rename_no_replace(src, dst):
+    """Like os.rename(), but it fails if dst is another file instead of
+    replacing it."""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # a link left by an interrupted run is fine
+        if not os.path.samefile(src, dst):
+            raise
+
+    os.unlink(src)
+
+
+def execute(plan, dry_run=False):
+    """Do the renames and links planned by a RenamePlanner. With dry_run,
+    just print them. Returns the new names of the files that succeeded.
+
+    If one fails, the plan for the rest is not valid anymore, as that file
+    keeps its old name, so nothing is overwritten (see rename_no_replace())."""
+    done = []
+    made_dirs = set()
+
+    for src, dst, dst_by_date, collided in plan:
+        if dst != src:
+            print("%s -> %s" % (src, dst))
+        else:
+            print("%s already in good format, not renaming." % src)
+
+        if dst_by_date is not None:
+            print("%s => %s" % (dst_by_date, dst))
+
+        if dry_run:
+            continue
+
+        try:
+            if dst != src:
+                rename_no_replace(src, dst)
+
+            if dst_by_date is not None:
+                dst_by_date_dir = os.path.dirname(dst_by_date)
+                if dst_by_date_dir not in made_dirs:
+                    os.makedirs(dst_by_date_dir, exist_ok=True)
+                    made_dirs.add(dst_by_date_dir)
+
+                os.link(dst, dst_by_date)
+        except OSError as e:
+            print(e, src)
+        else:
+            done.append(dst)
+
+    return done
+
+
+def init_worker():
+    """GExiv2 has to be initialized before it's used from several threads,
+    and once per process."""
+    GExiv2.initialize()
+
+
+def rename_files(srcs, dry_run=False, jobs=1):
+    """Like calling rename_file() for each of srcs, in that order, but
+    planning them all first (see RenamePlanner).
+
+    With jobs > 1 the dates are read by that many processes; the files are
+    still planned and renamed in order."""
+    start = time.monotonic()
+    srcs = list(srcs)
+
+    if jobs > 1:
+        # no forking, we could have been called from a program with threads
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            dates = list(executor.map(read_date, srcs, chunksize=16))
+    else:
+        dates = [ read_date(src) for src in srcs ]
+
+    planner = RenamePlanner()
+    plan = []
+    skipped = 0
+
+    for src, date in zip(srcs, dates):
+        if date is None:
+            print("%s: can't find file's date, skipping..." % src)
+            skipped += 1
+        else:
+            plan.append(planner.plan(src, date))
+
+    done = execute(plan, dry_run)
+
+    elapsed = time.monotonic() - start
+    # those already in good format and linked are done, but not renamed
+    succeeded = set(done)
+    renamed = sum(1 for src, dst, dst_by_date, collided in plan
+                  if dst in succeeded and (dst != src or dst_by_date is not None))
+    collided = sum(1 for entry in plan if entry[3])
+    print("%d files in %.1fs (%.1f files/s): %d renamed, %d skipped for missing date, %d collided"
+          % (len(srcs), elapsed, len(srcs) / max(elapsed, 0.001), renamed, skipped, collided))
+
+    return done
+
+
 if __name__=='__main__':
     parser= argparse.ArgumentParser ()
     parser.add_argument ('-n', '--dry-run', action='store_true', default=False)
+    parser.add_argument ('-j', '--jobs', type=int, default=1,
+                         help='read the dates with this many processes')
     parser.add_argument ('sources', metavar='FILE_OR_DIR', nargs='*',
                         default=glob ('incoming/01-tmp/*'))
     opts= parser.parse_args (sys.argv[1:])
 
+    init_worker()
+
+    srcs = []
     for src in opts.sources:
         try:
             s= os.stat (src)
@@ -192,12 +443,12 @@ if __name__=='__main__':
             print ("%s: File not found" % src)
         else:
             if stat.S_ISREG (s.st_mode):
-                rename_file (src, opts.dry_run)
+                srcs.append(src)
             else:
                 # BUG: it could be something else..
                 for dirpath, dirnames, filenames in os.walk (src):
                     # sorting them by name helps resolving same second conflicts
                     for filename in sorted (filenames):
-                        f= os.path.join (dirpath, filename)
+                        srcs.append(os.path.join (dirpath, filename))
 
-                        rename_file (f, opts.dry_run)
+    rename_files(srcs, opts.dry_run, opts.jobs)
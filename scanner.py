@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+import logging
+logger = logging.getLogger("scanner")
+
+
+class Scanner(QObject):
+    """Finds the images under a directory in a background thread, reporting
+    them in sorted batches as it goes, so they can be shown before the scan
+    finishes.
+
+    With workers > 1, the subdirectories of the root are walked in parallel,
+    which helps with network and other high latency filesystems."""
+
+    # list of paths, sorted
+    found = pyqtSignal(list)
+    # total amount of images found; by then dirs has all the directories scanned
+    finished = pyqtSignal(int)
+
+
+    def __init__(self, extensions=('.jpg', '.png'), batch_size=1000, workers=1, parent=None):
+        QObject.__init__(self, parent)
+        self.extensions = extensions
+        self.batch_size = batch_size
+        self.workers = workers
+        # the directories scanned
+        self.dirs = []
+
+
+    def start(self, root):
+        self.dirs = []
+        thread = Thread(target=self.run, args=(os.path.abspath(root), ),
+                        name='scanner', daemon=True)
+        thread.start()
+
+
+    def run(self, root):
+        total = 0
+
+        try:
+            if self.workers > 1:
+                subdirs = []
+                # the root's own files first, and it gives us the subdirs
+                total += self.scan(root, subdirs)
+
+                with ThreadPoolExecutor(max_workers=self.workers,
+                                        thread_name_prefix='scanner') as executor:
+                    total += sum(executor.map(self.scan, subdirs))
+            else:
+                total += self.scan(root)
+        except Exception as e:
+            logger.error("scanning %s: %s", root, e)
+        finally:
+            self.finished.emit(total)
+
+
+    def scan(self, top, subdirs=None):
+        """Scan top. If subdirs is a list, its subdirectories are not
+        scanned but added to it. Returns how many images were found."""
+        batch = []
+        total = 0
+
+        for path in self.walk(top, subdirs):
+            batch.append(path)
+
+            if len(batch) == self.batch_size:
+                self.found.emit(sorted(batch))
+                total += len(batch)
+                batch = []
+
+        if len(batch) > 0:
+            self.found.emit(sorted(batch))
+            total += len(batch)
+
+        return total
+
+
+    def list_dir(self, dir, mtimes=None):
+        """Return the paths of the images and the subdirectories in dir. Like
+        os.walk(), symlinks to directories are not followed. If mtimes is a
+        dict, the images' mtimes are added to it."""
+        images = []
+        subdirs = []
+
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif entry.name[-4:].lower() in self.extensions:
+                    images.append(entry.path)
+
+                    if mtimes is not None:
+                        try:
+                            mtimes[entry.path] = entry.stat().st_mtime_ns
+                        except OSError:
+                            # it's gone already
+                            pass
+
+        return images, subdirs
+
+
+    def walk(self, top, subdirs=None):
+        """Yield the paths of the images under top, in order, a directory
+        at a time, so the first ones found are the first ones in the tree."""
+        dirs = [ top ]
+
+        while len(dirs) > 0:
+            dir = dirs.pop()
+
+            try:
+                images, found = self.list_dir(dir)
+            except OSError as e:
+                logger.info("could not scan %s: %s", dir, e)
+                continue
+
+            self.dirs.append(dir)
+            yield from sorted(images)
+
+            found.sort()
+            if subdirs is not None:
+                subdirs.extend(found)
+            else:
+                # it's a stack, so the first one goes last
+                dirs.extend(reversed(found))
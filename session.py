@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+import json
+
+import logging
+logger = logging.getLogger("session")
+
+
+class Session:
+    """An append-only journal of what's done in a session (the actions, the
+    images ignored, the positions, the cursor and whether we're comparing)
+    so it can be restored after a restart or a crash.
+
+    It also keeps the list of images found by the last scan in path.listing,
+    so they can be shown before scanning again.
+
+    The state of files that are gone is dropped with compact(), so the
+    journal doesn't grow forever, and a new file that reuses the name of
+    an old one doesn't inherit its state."""
+
+
+    def __init__(self, path):
+        self.path = path
+        self.listing_path = path + '.listing'
+        self.file = None
+
+
+    def load_listing(self):
+        """Return the paths of the last scan, sorted, or None."""
+        try:
+            with open(self.listing_path) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+
+    def save_listing(self, paths):
+        tmp = self.listing_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for path in paths:
+                f.write(path + '\n')
+
+        os.replace(tmp, self.listing_path)
+
+
+    def replay(self):
+        """Read the journal and return the state it leaves us in:
+
+        * actions: path -> action
+        * ignored: set of paths
+        * positions: path -> (x, y)
+        * cursor: path or None
+        * comparing: bool"""
+        state = dict(actions={}, ignored=set(), positions={}, cursor=None, comparing=False)
+
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return state
+
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # we probably crashed while writing it
+                    logger.warning("bad entry in %s: %r", self.path, line)
+                    continue
+
+                op = entry['op']
+                if op == 'action':
+                    if entry['action'] is None:
+                        state['actions'].pop(entry['path'], None)
+                    else:
+                        state['actions'][entry['path']] = entry['action']
+                elif op == 'ignored':
+                    if entry['ignored']:
+                        state['ignored'].add(entry['path'])
+                    else:
+                        state['ignored'].discard(entry['path'])
+                elif op == 'position':
+                    state['positions'][entry['path']] = (entry['x'], entry['y'])
+                elif op == 'cursor':
+                    state['cursor'] = entry['path']
+                elif op == 'comparing':
+                    state['comparing'] = entry['comparing']
+
+        return state
+
+
+    def open(self, state):
+        """Start journaling. The journal is rewritten with just the state."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for path, action in state['actions'].items():
+                self.write(f, op='action', path=path, action=action)
+
+            for path in state['ignored']:
+                self.write(f, op='ignored', path=path, ignored=True)
+
+            for path, (x, y) in state['positions'].items():
+                self.write(f, op='position', path=path, x=x, y=y)
+
+            if state['cursor'] is not None:
+                self.write(f, op='cursor', path=state['cursor'])
+
+            self.write(f, op='comparing', comparing=state['comparing'])
+
+        os.replace(tmp, self.path)
+
+        # line buffered, so every entry is written as it happens
+        self.file = open(self.path, 'a', buffering=1)
+
+
+    def compact(self, keep):
+        """Drop the state of the paths for which keep(path) is false, and
+        rewrite the journal."""
+        self.close()
+
+        state = self.replay()
+        for key in ('actions', 'positions'):
+            state[key] = { path: value for path, value in state[key].items() if keep(path) }
+
+        state['ignored'] = { path for path in state['ignored'] if keep(path) }
+        if state['cursor'] is not None and not keep(state['cursor']):
+            state['cursor'] = None
+
+        self.open(state)
+
+
+    def write(self, f, **entry):
+        f.write(json.dumps(entry) + '\n')
+
+
+    def record(self, **entry):
+        if self.file is not None:
+            self.write(self.file, **entry)
+
+
+    def action(self, path, action):
+        self.record(op='action', path=path, action=action)
+
+
+    def ignored(self, path, ignored=True):
+        self.record(op='ignored', path=path, ignored=ignored)
+
+
+    def position(self, path, position):
+        self.record(op='position', path=path, x=position.x(), y=position.y())
+
+
+    def cursor(self, path):
+        self.record(op='cursor', path=path)
+
+
+    def comparing(self, comparing):
+        self.record(op='comparing', comparing=comparing)
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
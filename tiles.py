@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+
+import math
+from collections import OrderedDict
+from threading import Lock
+
+from PyQt5.QtCore import QPoint, QRect, QRectF, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QImageReader, QImageIOHandler, QPainter, QPixmap
+from PyQt5.QtWidgets import QGraphicsItem, QGraphicsObject, QStyleOptionGraphicsItem
+
+from timing import Timings
+
+import logging
+logger = logging.getLogger("tiles")
+
+MiB = 1024 * 1024
+
+# the side of the tiles, in pixels of their level
+TILE = 512
+
+
+class TileSource:
+    """Decodes an image by tiles, at levels of detail: level 0 is the full
+    resolution, and each level is half the size of the previous one.
+
+    Tiles are decoded in bands of rows, with QImageReader's clip rects, at
+    the level's size (DCT scaling for JPEGs). libjpeg still decodes all the
+    scanlines above the clip, so the bands are as tall as fit in `budget`
+    bytes, which for most images means a whole level in one pass.
+    Formats that can't do that (TIFF, PNG) are decoded once, as big as fits
+    in `budget` bytes, and the tiles are cut from that."""
+
+
+    def __init__(self, path, size, budget=256 * MiB):
+        self.path = path
+        # the full image's
+        self.size = size
+        self.budget = budget
+
+        # the smallest level with a single tile
+        self.levels = max(0, math.ceil(math.log2(max(size.width(), size.height()) / TILE)))
+
+        reader = QImageReader(path)
+        self.clips = (reader.supportsOption(QImageIOHandler.ScaledClipRect) and
+                      reader.supportsOption(QImageIOHandler.ClipRect))
+        # see whole()
+        self.source = None
+        self.lock = Lock()
+
+
+    def level_size(self, level):
+        return QSize(math.ceil(self.size.width() / 2 ** level),
+                     math.ceil(self.size.height() / 2 ** level))
+
+
+    def columns(self, level):
+        return math.ceil(self.level_size(level).width() / TILE)
+
+
+    def rows(self, level):
+        return math.ceil(self.level_size(level).height() / TILE)
+
+
+    def band(self, level, row):
+        """The first and last + 1 rows of the band row is in."""
+        size = max(1, self.budget // (self.level_size(level).width() * TILE * 4))
+        first = row // size * size
+
+        return first, min(first + size, self.rows(level))
+
+
+    def tile_rect(self, level, column, row):
+        """The tile's rect in its level's pixels."""
+        return QRect(column * TILE, row * TILE, TILE, TILE).intersected(QRect(QPoint(), self.level_size(level)))
+
+
+    def scene_rect(self, level, column, row):
+        """The tile's rect in the full image's pixels, which is how the
+        scene is laid out."""
+        level_size = self.level_size(level)
+        x_scale = self.size.width() / level_size.width()
+        y_scale = self.size.height() / level_size.height()
+        rect = self.tile_rect(level, column, row)
+
+        return QRectF(rect.x() * x_scale, rect.y() * y_scale,
+                      rect.width() * x_scale, rect.height() * y_scale)
+
+
+    def whole(self):
+        """The whole image, decoded once, for formats without clip rects."""
+        with self.lock:
+            if self.source is None:
+                scale = min(1, math.sqrt(self.budget / (self.size.width() * self.size.height() * 4)))
+                reader = QImageReader(self.path)
+                if scale < 1:
+                    reader.setScaledSize(QSize(int(self.size.width() * scale),
+                                               int(self.size.height() * scale)))
+
+                self.source = reader.read()
+                if self.source.isNull():
+                    logger.warning("can't decode %s: %s", self.path, reader.errorString())
+
+            return self.source
+
+
+    def decode_band(self, level, first, last):
+        """Return the QImages of the tiles of those rows, a list per row, left
+        to right."""
+        level_size = self.level_size(level)
+        strip = QRect(0, first * TILE, level_size.width(),
+                      (last - first) * TILE).intersected(QRect(QPoint(), level_size))
+
+        if self.clips:
+            reader = QImageReader(self.path)
+            if level == 0:
+                reader.setClipRect(strip)
+            else:
+                reader.setScaledSize(level_size)
+                reader.setScaledClipRect(strip)
+
+            image = reader.read()
+            if image.isNull():
+                logger.warning("can't decode %s: %s", self.path, reader.errorString())
+                return []
+        else:
+            source = self.whole()
+            if source.isNull():
+                return []
+
+            x_scale = source.width() / level_size.width()
+            y_scale = source.height() / level_size.height()
+            image = source.copy(QRect(int(strip.x() * x_scale), int(strip.y() * y_scale),
+                                      max(1, int(strip.width() * x_scale)),
+                                      max(1, int(strip.height() * y_scale))))
+            image = image.scaled(strip.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+
+        return [ [ image.copy(QRect(column * TILE, row * TILE, TILE, TILE).intersected(image.rect()))
+                   for column in range(self.columns(level)) ]
+                 for row in range(last - first) ]
+
+
+class TileCache:
+    """The decoded tiles, as QPixmaps, with a byte budget and LRU eviction.
+    Only used from the UI thread."""
+
+
+    def __init__(self, budget=512 * MiB):
+        self.budget = budget
+        # (path, level, column, row) -> QPixmap, oldest first
+        self.tiles = OrderedDict()
+        self.resident = 0
+
+
+    def get(self, key):
+        pixmap = self.tiles.get(key)
+        if pixmap is not None:
+            self.tiles.move_to_end(key)
+
+        return pixmap
+
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+
+    def put(self, key, pixmap):
+        old = self.tiles.pop(key, None)
+        if old is not None:
+            self.resident -= old.width() * old.height() * 4
+
+        self.tiles[key] = pixmap
+        self.resident += pixmap.width() * pixmap.height() * 4
+
+        while self.resident > self.budget and len(self.tiles) > 1:
+            key, pixmap = self.tiles.popitem(last=False)
+            self.resident -= pixmap.width() * pixmap.height() * 4
+
+
+    def forget(self, path):
+        for key in [ key for key in self.tiles if key[0] == path ]:
+            pixmap = self.tiles.pop(key)
+            self.resident -= pixmap.width() * pixmap.height() * 4
+
+
+class TiledImage(QGraphicsObject):
+    """Shows a very big image in the scene (in the full image's coordinates,
+    like the QGraphicsPixmapItem) by tiles, decoding in the background only
+    the rows of tiles the view shows, at the level of detail it needs.
+
+    It goes on top of the image decoded to fit the screen, so that is what
+    shows where tiles are missing, and it draws nothing when that one has
+    enough resolution (min_scale).
+
+    The bands are timed as the 'tiles' stage in timings."""
+
+    # level, first row, list of lists of QImages
+    decoded = pyqtSignal(int, int, list)
+
+
+    def __init__(self, path, size, executor, cache, min_scale=0, budget=256 * MiB, timings=None):
+        QGraphicsObject.__init__(self)
+        self.source = TileSource(path, size, budget)
+        self.executor = executor
+        self.cache = cache
+        self.min_scale = min_scale
+        self.timings = timings if timings is not None else Timings()
+
+        # (level, first row of the band) -> Future
+        self.pending = {}
+        self.decoded.connect(self.band_decoded)
+
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.source.size.width(), self.source.size.height())
+
+
+    def level(self, scale):
+        """The coarsest level with at least scale view pixels per image pixel."""
+        if scale >= 1:
+            return 0
+
+        return min(int(math.log2(1 / scale)), self.source.levels)
+
+
+    def visible(self, level, rect):
+        """The (column, row) of the tiles in the level that intersect rect,
+        which is in the full image's coordinates."""
+        level_size = self.source.level_size(level)
+        x_scale = level_size.width() / self.source.size.width()
+        y_scale = level_size.height() / self.source.size.height()
+
+        first_column = max(0, int(rect.left() * x_scale) // TILE)
+        last_column = min(self.source.columns(level) - 1, int(rect.right() * x_scale) // TILE)
+        first_row = max(0, int(rect.top() * y_scale) // TILE)
+        last_row = min(self.source.rows(level) - 1, int(rect.bottom() * y_scale) // TILE)
+
+        return [ (column, row) for row in range(first_row, last_row + 1)
+                               for column in range(first_column, last_column + 1) ]
+
+
+    def paint(self, painter, option, widget=None):
+        scale = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        if scale <= self.min_scale * 1.01:
+            # the image below is good enough
+            return
+
+        level = self.level(scale)
+
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, scale < 1)
+        for column, row in self.visible(level, option.exposedRect):
+            pixmap = self.cache.get((self.source.path, level, column, row))
+            if pixmap is not None:
+                painter.drawPixmap(self.source.scene_rect(level, column, row), pixmap, QRectF(pixmap.rect()))
+
+        # while panning only a strip is exposed, but we want all that's in
+        # view, and a row above and below, so they're ready when we get there
+        if widget is not None:
+            in_view = painter.worldTransform().inverted()[0].mapRect(QRectF(widget.rect()))
+        else:
+            in_view = option.exposedRect
+
+        tiles = self.visible(level, in_view)
+        rows = { row for column, row in tiles }
+        columns = { column for column, row in tiles }
+        wanted = set()
+
+        for row in rows | { row - 1 for row in rows } | { row + 1 for row in rows }:
+            if 0 <= row < self.source.rows(level):
+                if any((self.source.path, level, column, row) not in self.cache for column in columns):
+                    wanted.add((level, row))
+
+        self.request(wanted)
+
+
+    def request(self, wanted):
+        """Decode the bands of those (level, row)s, and stop decoding the ones
+        not wanted anymore, if they didn't start yet."""
+        bands = { (level, ) + self.source.band(level, row) for level, row in wanted }
+        wanted = { (level, first) for level, first, last in bands }
+
+        for key, future in list(self.pending.items()):
+            if key not in wanted and future.cancel():
+                del self.pending[key]
+
+        # top to bottom
+        for level, first, last in sorted(bands):
+            if (level, first) not in self.pending:
+                future = self.executor.submit(self.decode_band, level, first, last)
+                self.pending[(level, first)] = future
+
+
+    def decode_band(self, level, first, last):
+        with self.timings.span('tiles'):
+            rows = self.source.decode_band(level, first, last)
+
+        self.decoded.emit(level, first, rows)
+
+
+    def band_decoded(self, level, first, rows):
+        self.pending.pop((level, first), None)
+
+        for row, images in enumerate(rows, first):
+            for column, image in enumerate(images):
+                self.cache.put((self.source.path, level, column, row), QPixmap.fromImage(image))
+
+        self.update()
+
+
+    def cancel(self):
+        for future in self.pending.values():
+            future.cancel()
+
+        self.pending.clear()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+
+import os
+import os.path
+import json
+import time
+import cProfile
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+import logging
+logger = logging.getLogger("timing")
+
+
+def stats(samples):
+    """Summary of a list of durations, in seconds."""
+    samples = sorted(samples)
+    if len(samples) == 0:
+        return dict(count=0)
+
+    def percentile(p):
+        return samples[min(int(p / 100 * len(samples)), len(samples) - 1)]
+
+    return dict(count=len(samples), total=sum(samples), mean=sum(samples) / len(samples),
+                p50=percentile(50), p95=percentile(95), p99=percentile(99), max=samples[-1])
+
+
+class Timings:
+    """Durations of the stages of the hot paths (decoding, reading the
+    metadata, painting...), keeping the last `samples` of each, so we can
+    tell which one makes navigating slow.
+
+    Spans can be recorded from any thread (the prefetcher's workers, the
+    batch), so it's locked."""
+
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        # stage -> deque of durations in seconds, in the order they were first seen
+        self.stages = OrderedDict()
+        self.lock = Lock()
+
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+
+    def add(self, stage, duration):
+        with self.lock:
+            samples = self.stages.get(stage)
+            if samples is None:
+                samples = self.stages[stage] = deque(maxlen=self.samples)
+
+            samples.append(duration)
+
+
+    def stats(self):
+        """stage -> stats(), see above."""
+        with self.lock:
+            stages = [ (stage, list(samples)) for stage, samples in self.stages.items() ]
+
+        return OrderedDict( (stage, stats(samples)) for stage, samples in stages )
+
+
+    def text(self):
+        """The stats as a table, in milliseconds."""
+        lines = [ f"{'stage':<16} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8}" ]
+
+        for stage, summary in self.stats().items():
+            lines.append(f"{stage:<16} {summary['count']:>6} {summary['p50'] * 1000:>8.2f} "
+                         f"{summary['p95'] * 1000:>8.2f} {summary['p99'] * 1000:>8.2f}")
+
+        return '\n'.join(lines)
+
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+            f.write('\n')
+
+        logger.info("timings written to %s", path)
+
+
+class Profiler:
+    """cProfile, started and stopped on demand. The stats are written to
+    path when stopped; read them with `python3 -m pstats path`.
+
+    It only profiles the thread that starts it, which is the UI thread."""
+
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = None
+
+
+    def running(self):
+        return self.profile is not None
+
+
+    def start(self):
+        logger.info("profiling")
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+
+    def stop(self):
+        self.profile.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.profile.dump_stats(self.path)
+        self.profile = None
+
+        logger.info("profile written to %s", self.path)
+
+
+    def toggle(self):
+        if self.running():
+            self.stop()
+        else:
+            self.start()
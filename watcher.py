@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+
+import os.path
+
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+import logging
+logger = logging.getLogger("watcher")
+
+
+class DirectoryWatcher(QObject):
+    """Watches directories for files being created, removed or renamed in
+    them (with inotify on Linux) and reports which ones changed.
+
+    Changes come in bursts (a camera writing, a batch moving files), so they
+    are collected for `delay` milliseconds and reported together. Directories
+    that were removed are reported too, so their files can be dropped."""
+
+    # list of directories
+    changed = pyqtSignal(list)
+
+
+    def __init__(self, delay=500, parent=None):
+        QObject.__init__(self, parent)
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.directory_changed)
+
+        self.dirty = set()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.report)
+
+        # all the ones we were told to watch; the watcher forgets about the
+        # removed ones, but we need them to find their subdirectories
+        self.dirs = set()
+
+
+    def watch(self, dirs):
+        dirs = [ dir for dir in dirs if dir not in self.dirs ]
+        if len(dirs) == 0:
+            return
+
+        failed = self.watcher.addPaths(dirs)
+        for dir in failed:
+            logger.warning("can't watch %s", dir)
+
+        self.dirs.update(dirs)
+
+
+    def directory_changed(self, dir):
+        self.dirty.add(dir)
+
+        if not os.path.isdir(dir):
+            # also report the subdirectories
+            prefix = dir + os.sep
+            self.dirty.update(subdir for subdir in self.dirs if subdir.startswith(prefix))
+
+        self.timer.start()
+
+
+    def report(self):
+        dirs = sorted(self.dirty)
+        self.dirty.clear()
+
+        for dir in dirs:
+            if not os.path.isdir(dir):
+                self.dirs.discard(dir)
+
+        logger.debug("changed: %r", dirs)
+        self.changed.emit(dirs)
@@ -3,11 +3,16 @@
 import os
 import os.path
 import shutil
+import errno
+import fcntl
+import hashlib
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5.QtWidgets import QApplication
-from PyQt5.QtGui import QPixmap
 
-from rename_pictures import rename_file
+from rename_pictures import rename_files
 
 import logging
 logger= logging.getLogger ("workflow")
@@ -17,42 +22,345 @@ class Opts:
     pass
 
 
+MiB = 1024 * 1024
+
+# ioctl to share the data blocks between files (reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def copy_data(src_fd, dst_fd, size, offset=0):
+    """Copy the data without passing it through userspace: a reflink if the
+    filesystem supports it, else copy_file_range(), else sendfile().
+
+    The first offset bytes are assumed to be already copied."""
+    try:
+        # this always clones the whole file
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return 'reflink'
+    except OSError:
+        pass
+
+    try:
+        copied = offset
+        while copied < size:
+            count = os.copy_file_range(src_fd, dst_fd, size - copied, copied, copied)
+            if count == 0:
+                break
+
+            copied += count
+
+        return 'copy_file_range'
+    except (OSError, AttributeError):
+        # not supported between these filesystems, or old python
+        # if it failed halfway, start over from offset
+        os.ftruncate(dst_fd, offset)
+
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    copied = offset
+    while copied < size:
+        count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if count == 0:
+            break
+
+        copied += count
+
+    return 'sendfile'
+
+
+def checksum(path):
+    hash = hashlib.blake2b()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hash.update(chunk)
+
+    return hash.digest()
+
+
+def import_file(src, dst, move=True, verify=False, resume=False):
+    """Returns the amount of bytes copied and how long the copy and the
+    verification took.
+
+    The data is copied to dst.part first. If resume is True and it's
+    already there, it's from an interrupted import of this same file (see
+    ImportManifest), so the copy resumes from where it stopped; otherwise
+    it's overwritten."""
+    size = os.stat(src).st_size
+
+    if move:
+        try:
+            # same filesystem, nothing to copy
+            os.rename(src, dst)
+            return 0, 0, 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    part = dst + '.part'
+    offset = 0
+    if resume:
+        try:
+            offset = os.stat(part).st_size
+        except FileNotFoundError:
+            pass
+
+    if offset > size:
+        offset = 0
+
+    start = time.monotonic()
+    with open(src, 'rb') as src_f, open(part, 'r+b' if offset > 0 else 'wb') as dst_f:
+        how = copy_data(src_f.fileno(), dst_f.fileno(), size, offset)
+
+    logger.debug("%s -> %s: %s from %d", src, dst, how, offset)
+
+    # like shutil.move() and shutil.copy() do
+    if move:
+        shutil.copystat(src, part)
+    else:
+        shutil.copymode(src, part)
+    copied = time.monotonic()
+
+    if verify and checksum(src) != checksum(part):
+        # the bad part might be the one we resumed from; start over next time
+        os.unlink(part)
+        raise OSError(f"{dst} is not the same as {src}")
+    verified = time.monotonic()
+
+    os.rename(part, dst)
+
+    if move:
+        os.unlink(src)
+
+    return size - offset, copied - start, verified - copied
+
+
+def volume_id(path):
+    """Identify the filesystem path is in, so the same card is recognized
+    wherever it's mounted: its UUID if we can find it, else its mount point."""
+    path = os.path.realpath(path)
+    dev = os.stat(path).st_dev
+
+    try:
+        for uuid in os.listdir('/dev/disk/by-uuid'):
+            if os.stat(os.path.join('/dev/disk/by-uuid', uuid)).st_rdev == dev:
+                return uuid
+    except OSError:
+        pass
+
+    while path != '/' and os.stat(os.path.dirname(path)).st_dev == dev:
+        path = os.path.dirname(path)
+
+    return path
+
+
+class ImportManifest:
+    """A SQLite backed record of the files imported, keyed by the source's
+    volume, path relative to the imported dir, size and mtime, so
+    importing the same card again skips what's already done, even if those
+    files were renamed since.
+
+    Files are recorded as 'copying' with their destination before starting,
+    so an interrupted import resumes them with the same name."""
+
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS imported (
+                               volume TEXT NOT NULL,
+                               path TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               mtime INTEGER NOT NULL,
+                               dst TEXT NOT NULL,
+                               state TEXT NOT NULL,
+                               PRIMARY KEY (volume, path, size, mtime)
+                           )''')
+        self.db.commit()
+
+
+    def get(self, key):
+        """Return (dst, state) for the source with that key, or None."""
+        return self.db.execute('''SELECT dst, state FROM imported
+                                  WHERE volume = ? AND path = ? AND size = ? AND mtime = ?''',
+                               key).fetchone()
+
+
+    def set(self, key, dst, state):
+        self.set_many([ (key, dst, state) ])
+
+
+    def set_many(self, entries):
+        """Like set() for a list of (key, dst, state), in one transaction,
+        so it's synced to disk once."""
+        self.db.executemany('INSERT OR REPLACE INTO imported VALUES (?, ?, ?, ?, ?, ?)',
+                            [ key + (dst, state) for key, dst, state in entries ])
+        self.db.commit()
+
+
+    def destinations(self):
+        """The destinations of the imports in progress."""
+        return set(dst for dst, in self.db.execute("SELECT dst FROM imported WHERE state = 'copying'"))
+
+
+def is_taken(dst, taken):
+    """Whether dst is taken, exists, or is being copied (see import_file())."""
+    return dst in taken or os.path.exists(dst) or os.path.exists(dst + '.part')
+
+
+def unique_name(dst, taken):
+    """Return dst, or dst with a -N suffix if that's already taken or exists."""
+    base, ext = os.path.splitext(dst)
+    n = 0
+
+    while is_taken(dst, taken):
+        n += 1
+        dst = f"{base}-{n}{ext}"
+
+    return dst
+
+
 # SD -> 01-tmp
-def import_files(src_dir, dst_dir, move=True):
+def import_files(src_dir, dst_dir, move=True, workers=4, verify=False, manifest=None):
+    """Copy (or move) all the files in src_dir to dst_dir with a pool of
+    workers. If verify is True, the copies are checked against the sources
+    before removing them.
+
+    With a manifest (see ImportManifest), files imported before are skipped
+    and interrupted ones resumed. Files with the same name as another one
+    being imported, or one already in dst_dir, get a -N suffix instead of
+    overwriting it."""
     imported = []
 
-    if move:
-        op = shutil.move
+    start = time.monotonic()
+    total_size = 0
+    copy_time = 0
+    verify_time = 0
+    count = 0
+    skipped = 0
+
+    if manifest is not None:
+        volume = volume_id(src_dir)
+        # the names of the interrupted imports, kept for them
+        resuming = manifest.destinations()
     else:
-        op = shutil.copy
+        resuming = set()
+
+    # plan everything before copying anything, so collisions are detected
+    # among all the files and not just against those already copied
+    plan = []
+    taken = set(resuming)
+    # (key, dst, 'done') not recorded in the manifest yet
+    done = []
 
     # TODO: put paths in config file
     for root, dirs, files in os.walk(src_dir):
-        for file in files:
+        for file in sorted(files):
             src = os.path.join(root, file)
             dst = os.path.join(dst_dir, file)
+            key = None
+
+            if manifest is not None:
+                s = os.stat(src)
+                key = (volume, os.path.relpath(src, src_dir), s.st_size, s.st_mtime_ns)
+                entry = manifest.get(key)
 
+                if entry is not None:
+                    dst, state = entry
+
+                    if state == 'done':
+                        skipped += 1
+                        if os.path.exists(dst):
+                            # still not renamed
+                            imported.append(dst)
+                        continue
+
+                    if os.path.exists(dst) and os.stat(dst).st_size == s.st_size:
+                        # it was copied, but we died before recording it
+                        done.append( (key, dst, 'done') )
+                        imported.append(dst)
+                        continue
+
+                    # resume it with the same name
+                    taken.add(dst)
+                    plan.append( (src, dst, key, True) )
+                    continue
+
+            if is_taken(dst, taken):
+                new_dst = unique_name(dst, taken)
+                logger.warning("%s is already taken, importing %s as %s", dst, src, new_dst)
+                dst = new_dst
+
+            taken.add(dst)
+            plan.append( (src, dst, key, False) )
+
+    if manifest is not None:
+        manifest.set_many([ (key, dst, 'copying') for src, dst, key, resume in plan ])
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import') as executor:
+        jobs = []
+
+        for src, dst, key, resume in plan:
             logger.info("%s -> %s", src, dst)
-            op(src, dst)
-            imported.append(dst)
+            jobs.append( (src, dst, key, executor.submit(import_file, src, dst, move, verify, resume)) )
+
+        for src, dst, key, future in jobs:
+            try:
+                size, copy_seconds, verify_seconds = future.result()
+            except OSError as e:
+                logger.error("could not import %s: %s", src, e)
+            else:
+                if key is not None:
+                    done.append( (key, dst, 'done') )
+
+                    # if we die, the ones not recorded are found as copied
+                    # in the next import, see above
+                    if len(done) >= 100:
+                        manifest.set_many(done)
+                        done = []
+
+                imported.append(dst)
+
+                count += 1
+                total_size += size
+                copy_time += copy_seconds
+                verify_time += verify_seconds
+
+    if manifest is not None and len(done) > 0:
+        manifest.set_many(done)
+
+    elapsed = time.monotonic() - start
+
+    report = (f"imported {count} files in {elapsed:.1f}s, "
+              f"{total_size / MiB:.1f}MiB copied at {rate(total_size, elapsed)}")
+    if total_size > 0:
+        # verifying reads both the card and the disk; comparing these tells
+        # if the card's reader or the disk is the bottleneck
+        report += f"; per worker: copying at {rate(total_size, copy_time)}"
+        if verify:
+            report += f", verifying at {rate(2 * total_size, verify_time)}"
+    if skipped > 0:
+        report += f"; {skipped} already imported"
+
+    print(report)
 
     return imported
 
 
+def rate(size, seconds):
+    return f"{size / MiB / max(seconds, 0.001):.1f}MiB/s"
+
+
 # NKN_XXX -> date based
 # TODO: paths in rename_pictures to config file
 def rename():
-    opts = Opts()
-    opts.dry_run = False
-
     for root, dirs, files in os.walk('/home/mdione/Pictures/incoming/01-tmp'):
-        for file in sorted(files):
-            rename_file(os.path.join(root, file))
+        rename_files([ os.path.join(root, file) for file in sorted(files) ])
 
 
 def main ():
+    manifest = ImportManifest(os.path.expanduser('~/.cache/ananke/import.db'))
     import_files('/home/mdione/media/Nikon D7200/DCIM/',
-                 '/home/mdione/Pictures/incoming/01-tmp')
+                 '/home/mdione/Pictures/incoming/01-tmp', manifest=manifest)
     rename()
 
 